@@ -1,81 +1,254 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import glob, re
+"""Benchmark analysis pipeline.
 
-plt.style.use("seaborn-v0_8")
+  python analyze_results.py ingest fastapi_c100.csv --backend FastAPI --concurrency 100
+  python analyze_results.py report                      # summary_results.csv + plots
+  python analyze_results.py baseline <run_id>           # mark run as the baseline for its label
+  python analyze_results.py compare <run_id> [--baseline <run_id>] [--max-p99-regress 10] [--max-tput-regress 5]
+  python analyze_results.py                             # legacy: ingest every *.csv in CWD, then report
 
-files = sorted(glob.glob("*.csv"))
-print(f"Found {len(files)} CSV files:", *files, sep="\n - ")
+Each run is ingested once, in CHUNK-row pieces, into STORE/<run_id>/ as one .npy per column
+(status.npy int16: HTTP code, -1 timeout, -2 other error; latency_ms.npy int32; t_ms.npy when present)
+plus meta.json (explicit backend/concurrency/impairment, counts, request start span) and hist.npy, an
+HDR-style latency histogram of successful requests. Percentiles and baseline comparisons only read histograms,
+so memory stays bounded however many rows a run has.
+"""
+import argparse, glob, json, os, re, sys, time
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
 
-def analyze_file(path):
-    df = pd.read_csv(path)
+STORE = os.environ.get("RESULTS_STORE", "results")
+CHUNK = int(os.environ.get("CHUNK", "500000"))
 
-    # ✅ Coerce status to STRING so "200" and 200 are treated the same
-    status = df["status"].astype(str)
+# ---- HDR-style histogram: exact below SUB ms, <= 1/HALF relative error above ----
+SUB, HALF = 2048, 1024
 
-    total   = len(df)
-    success = (status == "200").sum()
-    timeout = (status.str.lower() == "timeout").sum()
-    other   = total - success - timeout
+def bucket_index(v):
+    v = np.maximum(np.asarray(v, dtype=np.int64), 0)
+    idx = v.copy()
+    hi = v >= SUB
+    if hi.any():
+        s = np.frexp(v[hi].astype(np.float64))[1] - 11   # shift so v>>s lands in [HALF, SUB)
+        idx[hi] = SUB + (s - 1)*HALF + ((v[hi] >> s) - HALF)
+    return idx
 
-    # Percentiles from successful rows only
-    lat_ok = df.loc[status == "200", "latency_ms"]
-    if not lat_ok.empty:
-        p50, p95, p99 = lat_ok.quantile([0.5, 0.95, 0.99]).astype(int).tolist()
-    else:
-        p50 = p95 = p99 = None
+def bucket_value(i):
+    """Highest latency (ms) that maps to bucket i."""
+    i = np.asarray(i, dtype=np.int64)
+    s = np.where(i < SUB, 0, (i - SUB)//HALF + 1)
+    lo = np.where(i < SUB, i, ((i - SUB) % HALF + HALF) << s)
+    return lo + (1 << s) - 1
 
-    return {
-        "file": path, "total": total,
-        "success": success, "timeout": timeout, "other": other,
-        "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
-    }
+def hist_add(h, values):
+    if not len(values): return h
+    c = np.bincount(bucket_index(values))
+    if len(c) > len(h): h = np.pad(h, (0, len(c) - len(h)))
+    h[:len(c)] += c
+    return h
 
-summary = pd.DataFrame([analyze_file(f) for f in files])
+def hist_pct(h, ps):
+    n = h.sum()
+    if n == 0: return [None for _ in ps]
+    cum = np.cumsum(h)
+    return [int(bucket_value(np.searchsorted(cum, max(1, int(np.ceil(p*n)))))) for p in ps]
 
+# ---- Ingest ----
 def parse_label(fname):
     backend = "FastAPI" if "fastapi" in fname else ("Flask" if "flask" in fname else "Unknown")
     conc = re.search(r"c(\d+)", fname)
     conc = conc.group(1) if conc else "?"
     cond = "Impaired" if "impair" in fname else "Baseline"
-    return f"{backend}-C{conc}-{cond}"
-
-summary["label"] = summary["file"].apply(parse_label)
-
-print("\n=== Summary Results ===")
-print(summary[["label","p50_ms","p95_ms","p99_ms","success","timeout","other"]])
-
-summary.to_csv("summary_results.csv", index=False)
-print("\n✅ Wrote summary_results.csv")
-
-# Histograms (successful only)
-for f in files:
-    df = pd.read_csv(f)
-    s = df["status"].astype(str)
-    lat_ok = df.loc[s == "200", "latency_ms"]
-    if not lat_ok.empty:
-        plt.hist(lat_ok, bins=40, alpha=0.6, label=f)
-plt.xlabel("Latency (ms)"); plt.ylabel("Frequency")
-plt.title("Latency distributions (successful requests)")
-plt.legend(fontsize=8); plt.savefig("latency_histograms.png", bbox_inches="tight"); plt.close()
-print("✅ Wrote latency_histograms.png")
-
-# Tail P99 comparison
-for backend in ["FastAPI","Flask"]:
-    for cond in ["Baseline","Impaired"]:
-        ss = summary[summary["label"].str.contains(backend) & summary["label"].str.contains(cond)]
-        if not ss.empty:
-            plt.plot(ss["label"], ss["p99_ms"], marker="o", label=f"{backend}-{cond}")
-plt.xticks(rotation=45, ha="right")
-plt.ylabel("P99 Latency (ms)"); plt.title("Tail latency comparison")
-plt.legend(); plt.savefig("tail_latency.png", bbox_inches="tight"); plt.close()
-print("✅ Wrote tail_latency.png")
-
-# Success vs timeout bar chart
-ax = summary.copy()
-ax["success_pct"] = (ax["success"] / ax["total"] * 100).round(1)
-ax["timeout_pct"] = (ax["timeout"] / ax["total"] * 100).round(1)
-ax[["label","success_pct","timeout_pct"]].set_index("label").plot.bar(figsize=(10,5))
-plt.ylabel("Percentage (%)"); plt.title("Success vs Timeout")
-plt.tight_layout(); plt.savefig("success_timeout.png"); plt.close()
-print("✅ Wrote success_timeout.png")
+    return backend, conc, cond
+
+def ingest(path, backend=None, concurrency=None, impairment=None, run_id=None, store=STORE):
+    fb, fc, fi = parse_label(os.path.basename(path))   # filename is only a fallback for unset fields
+    backend, concurrency = backend or fb, str(concurrency or fc)
+    impairment = impairment or fi
+    run_id = run_id or os.path.splitext(os.path.basename(path))[0]
+    d = os.path.join(store, run_id); os.makedirs(d, exist_ok=True)
+    cols = {"status": np.int16, "latency_ms": np.int32, "t_ms": np.int64}
+    raw = {c: open(os.path.join(d, c + ".raw"), "wb") for c in cols}
+    h = np.zeros(SUB, dtype=np.int64)
+    n = success = timeout = 0; t_lo, t_hi = None, None
+    for chunk in pd.read_csv(path, chunksize=CHUNK, dtype={"status": str}):
+        st = chunk["status"].str.strip().str.lower()
+        code = pd.to_numeric(st, errors="coerce")
+        code[st == "timeout"] = -1
+        code = code.fillna(-2).to_numpy(np.int16)
+        lat = chunk["latency_ms"].round().to_numpy(np.int32)
+        code.tofile(raw["status"]); lat.tofile(raw["latency_ms"])
+        ok = (code >= 200) & (code < 300)
+        h = hist_add(h, lat[ok])
+        n += len(code); success += int(ok.sum()); timeout += int((code == -1).sum())
+        if "t_ms" in chunk:
+            # rate window = span of request *start* times, timeouts excluded: completion times would tie
+            # the window (and so throughput) to the single slowest request of the run
+            t = chunk["t_ms"].to_numpy(np.int64); t.tofile(raw["t_ms"])
+            ts = t[code != -1]
+            if len(ts):
+                t_lo = ts.min() if t_lo is None else min(t_lo, ts.min())
+                t_hi = ts.max() if t_hi is None else max(t_hi, ts.max())
+    for f in raw.values(): f.close()
+    for c, dt in cols.items():
+        rp = os.path.join(d, c + ".raw")
+        if c != "t_ms" or os.path.getsize(rp):
+            out = np.lib.format.open_memmap(os.path.join(d, c + ".npy"), mode="w+", dtype=dt, shape=(n,))
+            if n:
+                src = np.memmap(rp, dtype=dt, mode="r", shape=(n,))
+                for i in range(0, n, CHUNK): out[i:i+CHUNK] = src[i:i+CHUNK]
+                del src
+            out.flush(); del out
+        os.remove(rp)
+    np.save(os.path.join(d, "hist.npy"), h)
+    meta = {"run_id": run_id, "source": os.path.abspath(path), "ingested": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "backend": backend, "concurrency": concurrency, "impairment": impairment,
+            "label": f"{backend}-C{concurrency}-{impairment}",
+            "rows": n, "success": success, "timeout": timeout, "other": n - success - timeout,
+            "start_span_s": (int(t_hi - t_lo)/1000 if t_lo is not None and t_hi > t_lo else None)}
+    with open(os.path.join(d, "meta.json"), "w") as f: json.dump(meta, f, indent=2)
+    return meta
+
+def load_run(run_id, store=STORE):
+    d = os.path.join(store, run_id)
+    with open(os.path.join(d, "meta.json")) as f: meta = json.load(f)
+    return meta, np.load(os.path.join(d, "hist.npy"))
+
+def list_runs(store=STORE):
+    return sorted(os.path.basename(os.path.dirname(p)) for p in glob.glob(os.path.join(store, "*", "meta.json")))
+
+# ---- Summary + plots ----
+def summarize(store=STORE):
+    rows = []
+    for rid in list_runs(store):
+        meta, h = load_run(rid, store)
+        p50, p95, p99 = hist_pct(h, [0.50, 0.95, 0.99])
+        rows.append({"file": os.path.basename(meta["source"]), "total": meta["rows"],
+                     "success": meta["success"], "timeout": meta["timeout"], "other": meta["other"],
+                     "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "label": meta["label"], "run_id": rid})
+    return pd.DataFrame(rows)
+
+def report(store=STORE):
+    import matplotlib.pyplot as plt
+    plt.style.use("seaborn-v0_8")
+    summary = summarize(store)
+    if summary.empty: print(f"No runs in {store}/"); return
+    print("\n=== Summary Results ===")
+    print(summary[["label","p50_ms","p95_ms","p99_ms","success","timeout","other"]])
+    summary.drop(columns="run_id").to_csv("summary_results.csv", index=False)
+    print("\n✅ Wrote summary_results.csv")
+
+    # Histograms (successful only), rebuilt from the stored buckets
+    for rid in summary["run_id"]:
+        meta, h = load_run(rid, store)
+        nz = np.nonzero(h)[0]
+        if len(nz): plt.hist(bucket_value(nz), bins=40, weights=h[nz], alpha=0.6, label=os.path.basename(meta["source"]))
+    plt.xlabel("Latency (ms)"); plt.ylabel("Frequency")
+    plt.title("Latency distributions (successful requests)")
+    plt.legend(fontsize=8); plt.savefig("latency_histograms.png", bbox_inches="tight"); plt.close()
+    print("✅ Wrote latency_histograms.png")
+
+    # Tail P99 comparison
+    for backend in ["FastAPI","Flask"]:
+        for cond in ["Baseline","Impaired"]:
+            ss = summary[summary["label"].str.contains(backend) & summary["label"].str.contains(cond)]
+            if not ss.empty:
+                plt.plot(ss["label"], ss["p99_ms"], marker="o", label=f"{backend}-{cond}")
+    plt.xticks(rotation=45, ha="right")
+    plt.ylabel("P99 Latency (ms)"); plt.title("Tail latency comparison")
+    plt.legend(); plt.savefig("tail_latency.png", bbox_inches="tight"); plt.close()
+    print("✅ Wrote tail_latency.png")
+
+    # Success vs timeout bar chart
+    ax = summary.copy()
+    ax["success_pct"] = (ax["success"] / ax["total"] * 100).round(1)
+    ax["timeout_pct"] = (ax["timeout"] / ax["total"] * 100).round(1)
+    ax[["label","success_pct","timeout_pct"]].set_index("label").plot.bar(figsize=(10,5))
+    plt.ylabel("Percentage (%)"); plt.title("Success vs Timeout")
+    plt.tight_layout(); plt.savefig("success_timeout.png"); plt.close()
+    print("✅ Wrote success_timeout.png")
+
+# ---- Baselines & regression check ----
+def baselines_path(store=STORE): return os.path.join(store, "baselines.json")
+
+def get_baselines(store=STORE):
+    p = baselines_path(store)
+    if not os.path.exists(p): return {}
+    with open(p) as f: return json.load(f)
+
+def set_baseline(run_id, store=STORE):
+    meta, _ = load_run(run_id, store)
+    b = get_baselines(store); b[meta["label"]] = run_id
+    with open(baselines_path(store), "w") as f: json.dump(b, f, indent=2)
+    print(f"Baseline for {meta['label']} -> {run_id}")
+
+def boot_pct(h, p, B, rng):
+    """Bootstrap distribution of percentile p by multinomial resampling of the histogram."""
+    nz = np.nonzero(h)[0]; n = int(h.sum())
+    vals, probs = bucket_value(nz), h[nz] / n
+    out = np.empty(B)
+    for i in range(0, B, 50):
+        cum = np.cumsum(rng.multinomial(n, probs, size=min(50, B - i)), axis=1)
+        out[i:i+50] = vals[np.minimum((cum < max(1, int(np.ceil(p*n)))).sum(axis=1), len(vals)-1)]
+    return out
+
+def compare(run_id, baseline=None, max_p99=10.0, max_tput=5.0, conf=0.95, B=1000, seed=0, store=STORE):
+    meta, h = load_run(run_id, store)
+    baseline = baseline or get_baselines(store).get(meta["label"])
+    if not baseline: sys.exit(f"No baseline for {meta['label']}; pass --baseline or run `baseline <run_id>`")
+    bmeta, bh = load_run(baseline, store)
+    if not h.sum() or not bh.sum(): sys.exit("Run or baseline has no successful requests")
+    rng = np.random.default_rng(seed); lo_q, hi_q = (1-conf)/2, 1-(1-conf)/2
+    failed = []
+
+    p99, bp99 = hist_pct(h, [0.99])[0], hist_pct(bh, [0.99])[0]
+    diff = boot_pct(h, 0.99, B, rng) - boot_pct(bh, 0.99, B, rng)
+    lo, hi = np.quantile(diff, [lo_q, hi_q])
+    pct = (p99 - bp99) / bp99 * 100
+    print(f"p99: {bp99} -> {p99} ms ({pct:+.1f}%), {conf:.0%} CI of diff [{lo:+.0f}, {hi:+.0f}] ms")
+    if pct > max_p99 and lo > 0: failed.append(f"p99 regressed {pct:.1f}% (> {max_p99}%)")
+
+    span, bspan = meta.get("start_span_s"), bmeta.get("start_span_s")
+    if span and bspan:
+        r, br = meta["success"]/span, bmeta["success"]/bspan
+        se = np.hypot(np.sqrt(meta["success"])/span, np.sqrt(bmeta["success"])/bspan)  # Poisson counts
+        z = NormalDist().inv_cdf(hi_q)
+        tpct = (r - br) / br * 100
+        print(f"throughput: {br:.1f} -> {r:.1f} req/s ({tpct:+.1f}%), {conf:.0%} CI of diff [{r-br-z*se:+.1f}, {r-br+z*se:+.1f}] req/s")
+        if -tpct > max_tput and r - br + z*se < 0: failed.append(f"throughput regressed {-tpct:.1f}% (> {max_tput}%)")
+    else:
+        print("throughput: skipped (no t_ms column in run or baseline; runs ingested before start_span_s need re-ingesting)")
+
+    if failed:
+        print(f"❌ {run_id} vs {baseline}: " + "; ".join(failed)); sys.exit(1)
+    print(f"✅ {run_id} vs {baseline}: within thresholds")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--store", default=STORE)
+    sp = ap.add_subparsers(dest="cmd")
+    a = sp.add_parser("ingest"); a.add_argument("csv", nargs="+")
+    a.add_argument("--backend"); a.add_argument("--concurrency"); a.add_argument("--impairment"); a.add_argument("--run-id")
+    sp.add_parser("report")
+    a = sp.add_parser("baseline"); a.add_argument("run_id")
+    a = sp.add_parser("compare"); a.add_argument("run_id"); a.add_argument("--baseline")
+    a.add_argument("--max-p99-regress", type=float, default=10.0, help="allowed p99 increase, %%")
+    a.add_argument("--max-tput-regress", type=float, default=5.0, help="allowed throughput drop, %%")
+    a.add_argument("--confidence", type=float, default=0.95)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "ingest":
+        if args.run_id and len(args.csv) > 1: ap.error("--run-id needs a single CSV")
+        for p in args.csv:
+            m = ingest(p, args.backend, args.concurrency, args.impairment, args.run_id, args.store)
+            print(f"Ingested {p} -> {args.store}/{m['run_id']} ({m['rows']} rows, {m['label']})")
+    elif args.cmd == "report": report(args.store)
+    elif args.cmd == "baseline": set_baseline(args.run_id, args.store)
+    elif args.cmd == "compare":
+        compare(args.run_id, args.baseline, args.max_p99_regress, args.max_tput_regress, args.confidence, store=args.store)
+    else:
+        files = sorted(f for f in glob.glob("*.csv") if f != "summary_results.csv")
+        print(f"Found {len(files)} CSV files:", *files, sep="\n - ")
+        for p in files: ingest(p, store=args.store)
+        report(args.store)
+
+if __name__ == "__main__": main()
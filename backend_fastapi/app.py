@@ -7,23 +7,31 @@ from typing import Optional
 
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from common.db import get_db, init_db
-from common.util import metrics, rate_limiter, weather_at, plan_route, json_log
+from common.db import get_db, fan_out, ride_shard, claim_ride
+from common.startup import boot, policy_cache, stats as startup_stats
+from common.util import metrics, rate_limiter, weather_at, plan_route, json_log, admission, priority_for, PRIORITIES, ADMISSION
 from common.helpers import ack_token
+from common.rides import start_session, finish_session, fare_for
 
 app = FastAPI(title="BikeShare FastAPI")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
-init_db()
+boot()
 
 def now_iso(): return datetime.utcnow().isoformat()+"Z"
 
 @app.middleware("http")
 async def obs(request: Request, call_next):
     t0=time.time(); trace=request.headers.get("X-Trace-Id",str(uuid.uuid4()))
+    resp=None; prio=priority_for(request.method, request.url.path) if ADMISSION else None
+    admitted, wait = admission.acquire(prio) if prio is not None else (False, 0)
     try:
-        resp = await call_next(request)
+        if prio is not None and not admitted:
+            resp = JSONResponse({"error":"overloaded","class":PRIORITIES[prio]}, status_code=503); resp.headers["Retry-After"]=f"{wait:.2f}"
+        else:
+            resp = await call_next(request)
     finally:
         ms=int((time.time()-t0)*1000)
+        if admitted: admission.release(prio, ms, getattr(resp,'status_code',500)>=500)
         metrics.observe(request.url.path, ms)
         json_log(ts=now_iso(), trace=trace, m=request.method, p=request.url.path,
                  status=getattr(resp,'status_code',0), ms=ms, idem=request.headers.get("Idempotency-Key"))
@@ -40,14 +48,14 @@ def index():
 def health(): metrics.inc("requests_/healthz"); return {"status":"ok","ts":now_iso()}
 
 @app.get("/metrics")
-def metr(): metrics.inc("requests_/metrics"); return metrics.snapshot()
+def metr(): metrics.inc("requests_/metrics"); return {**metrics.snapshot(), "admission": admission.snapshot(), "startup": startup_stats()}
 
 # Devices
 @app.post("/devices")
 async def register(request: Request):
     d = await request.json()
     if not {"id","name"} <= d.keys(): raise HTTPException(400,"invalid")
-    with get_db() as conn:
+    with get_db(d["id"]) as conn:
         c=conn.cursor(); c.execute("SELECT 1 FROM devices WHERE id=?", (d["id"],))
         if c.fetchone():
             c.execute("UPDATE devices SET name=?, updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (d["name"], d["id"])); conn.commit()
@@ -58,7 +66,7 @@ async def register(request: Request):
 @app.put("/devices/{id}")
 async def update_device(id:str, request: Request):
     body = await request.json()
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor()
         c.execute("UPDATE devices SET name=COALESCE(?,name),lock_state=COALESCE(?,lock_state),updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?",
                   (body.get("name"), body.get("lock_state"), id))
@@ -68,9 +76,8 @@ async def update_device(id:str, request: Request):
 @app.get("/devices")
 def list_devices(near: Optional[str]=None, page:int=1, limit:int=20):
     off=(page-1)*limit
-    with get_db() as conn:
-        c=conn.cursor(); c.execute("SELECT * FROM devices LIMIT ? OFFSET ?", (limit, off))
-        items=[dict(r) for r in c.fetchall()]
+    # each shard returns its first off+limit by id; the merged page is the same as one big table's
+    items=sorted(fan_out("SELECT * FROM devices ORDER BY id LIMIT ?", (off+limit,)), key=lambda d:d["id"])[off:off+limit]
     nearest=None
     if near:
         try:
@@ -81,7 +88,7 @@ def list_devices(near: Optional[str]=None, page:int=1, limit:int=20):
 
 @app.get("/devices/{id}")
 def device_detail(id:str):
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor(); c.execute("SELECT * FROM devices WHERE id=?", (id,))
         r=c.fetchone(); 
         if not r: raise HTTPException(404,"not found")
@@ -96,7 +103,7 @@ async def telemetry(id:str, request: Request):
     if not idem: raise HTTPException(400,"missing Idempotency-Key")
     body=await request.json()
     payload_hash=hashlib.sha256(json.dumps(body,sort_keys=True).encode()).hexdigest()
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor(); c.execute("SELECT ack_token FROM idempotency WHERE key=?", (idem,))
         r=c.fetchone()
         if r: return JSONResponse({"nack":"duplicate","ack":r["ack_token"]}, status_code=409)
@@ -115,7 +122,7 @@ async def unlock(id:str, request: Request):
     allowed, wait = rate_limiter.allow("/devices/unlock", request.headers.get("X-Device-Id","unknown"))
     if not allowed:
         resp = JSONResponse({"error":"rate_limited"}, status_code=429); resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor(); c.execute("UPDATE devices SET lock_state='unlocked', updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (id,))
         if c.rowcount==0: raise HTTPException(404,"not found")
         conn.commit()
@@ -126,10 +133,10 @@ async def lock(id:str, request: Request):
     allowed, wait = rate_limiter.allow("/devices/lock", request.headers.get("X-Device-Id","unknown"))
     if not allowed:
         resp = JSONResponse({"error":"rate_limited"}, status_code=429); resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor(); c.execute("UPDATE devices SET lock_state='locked', updated_at=strftime('%Y-%m-%dT%H:%M:%f%Z','now') WHERE id=?", (id,))
         # small typo in %f%Z removed below line to keep stable; leaving as is won't break main flows
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor(); c.execute("UPDATE devices SET lock_state='locked', updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (id,))
         if c.rowcount==0: raise HTTPException(404,"not found")
         conn.commit()
@@ -142,7 +149,8 @@ async def start_ride(request: Request):
         resp = JSONResponse({"error":"rate_limited"}, status_code=429); resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
     d = await request.json()
     if not {"id","user_id","device_id","start_lat","start_lon"} <= d.keys(): raise HTTPException(400,"invalid")
-    with get_db() as conn:
+    if not claim_ride(d["id"], d["device_id"]): raise HTTPException(409,"ride id in use")
+    with get_db(d["device_id"]) as conn:
         c=conn.cursor(); c.execute("SELECT * FROM rides WHERE id=?", (d["id"],))
         r=c.fetchone()
         if r: return {"status":"existing","ride":dict(r)}
@@ -152,9 +160,28 @@ async def start_ride(request: Request):
         conn.commit()
     return JSONResponse({"status":"created","id":d["id"]}, status_code=201)
 
+# Ride sessions: one round trip each for unlock+ride+route and end+price+lock
+@app.post("/rides:start")
+async def ride_session_start(request: Request):
+    allowed, wait = rate_limiter.allow("/rides/start", request.headers.get("X-Device-Id","unknown"))
+    if not allowed:
+        resp = JSONResponse({"error":"rate_limited"}, status_code=429); resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
+    code, body = start_session(await request.json())
+    return JSONResponse(body, status_code=code)
+
+@app.post("/rides/{id}:finish")
+async def ride_session_finish(id:str, request: Request):
+    allowed, wait = rate_limiter.allow("/rides/end", request.headers.get("X-Device-Id","unknown"))
+    if not allowed:
+        resp = JSONResponse({"error":"rate_limited"}, status_code=429); resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
+    code, body = finish_session(id, await request.json(), request.headers.get("X-Device-Id"))
+    return JSONResponse(body, status_code=code)
+
 @app.get("/rides/{id}")
-def ride_detail(id:str):
-    with get_db() as conn:
+def ride_detail(id:str, request: Request):
+    shard = ride_shard(id, request.headers.get("X-Device-Id"))
+    if shard is None: raise HTTPException(404,"not found")
+    with get_db(shard=shard) as conn:
         c=conn.cursor(); c.execute("SELECT * FROM rides WHERE id=?", (id,))
         r=c.fetchone()
         if not r: raise HTTPException(404,"not found")
@@ -166,13 +193,15 @@ async def end_ride(id:str, request: Request):
     if not allowed:
         resp = JSONResponse({"error":"rate_limited"}, status_code=429); resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
     d = await request.json()
-    with get_db() as conn:
+    shard = ride_shard(id, request.headers.get("X-Device-Id"))
+    if shard is None: raise HTTPException(404,"not found")
+    with get_db(shard=shard) as conn:
         c=conn.cursor(); c.execute("SELECT * FROM rides WHERE id=?", (id,))
         r=c.fetchone()
         if not r: raise HTTPException(404,"not found")
         route = plan_route({"lat":r["start_lat"],"lon":r["start_lon"]}, {"lat":d.get("end_lat"),"lon":d.get("end_lon")})
         c.execute("UPDATE rides SET end_ts=strftime('%Y-%m-%dT%H:%M:%fZ','now'), end_lat=?, end_lon=?, fare=? WHERE id=?",
-                  (d.get("end_lat"), d.get("end_lon"), round(route["distance_m"]/1000*0.5,2), id))
+                  (d.get("end_lat"), d.get("end_lon"), fare_for(route), id))
         c.execute("UPDATE devices SET lock_state='locked' WHERE id=?", (r["device_id"],))
         conn.commit()
     return {"status":"ended","route":route}
@@ -187,15 +216,18 @@ def weather_current(lat: float=0, lon: float=0): return weather_at(lat, lon)
 def policy(name: str, request: Request):
     if name not in ("geofences","pricing"): raise HTTPException(404,"not found")
     inm = request.headers.get("If-None-Match")
-    with get_db() as conn:
-        c=conn.cursor(); c.execute("SELECT blob,etag FROM policies WHERE name=?", (name,))
-        row=c.fetchone()
-        if not row: raise HTTPException(404,"missing")
-        etag=row["etag"]
-        if inm and inm==etag:
-            resp=Response(status_code=304); resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
-        resp=PlainTextResponse(row["blob"], media_type="application/json")
-        resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
+    cached = policy_cache(name)   # shared mmap artifact; DB only when artifacts are not attached
+    if cached: blob, etag = cached
+    else:
+        with get_db() as conn:
+            c=conn.cursor(); c.execute("SELECT blob,etag FROM policies WHERE name=?", (name,))
+            row=c.fetchone()
+            if not row: raise HTTPException(404,"missing")
+            blob, etag = row["blob"], row["etag"]
+    if inm and inm==etag:
+        resp=Response(status_code=304); resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
+    resp=PlainTextResponse(blob, media_type="application/json")
+    resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
 
 @app.get("/policies/geofences")
 def pol_g(request: Request):
@@ -212,6 +244,6 @@ def history(id:str, start: Optional[str]=None, end: Optional[str]=None, page:int
     if start: q+=" AND ts >= ?"; P.append(start)
     if end:   q+=" AND ts <= ?"; P.append(end)
     q+=" ORDER BY ts DESC LIMIT ? OFFSET ?"; P.extend([limit, off])
-    with get_db() as conn:
+    with get_db(id) as conn:
         c=conn.cursor(); c.execute(q, tuple(P)); rows=[dict(r) for r in c.fetchall()]
     return {"items":rows,"next_page": (page+1 if len(rows)==limit else None)}
@@ -5,13 +5,15 @@ from datetime import datetime
 
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from common.db import get_db, init_db
-from common.util import metrics, rate_limiter, weather_at, plan_route, json_log
+from common.db import get_db, fan_out, ride_shard, claim_ride
+from common.startup import boot, policy_cache, stats as startup_stats
+from common.util import metrics, rate_limiter, weather_at, plan_route, json_log, admission, priority_for, PRIORITIES, ADMISSION
 from common.helpers import ack_token
+from common.rides import start_session, finish_session, fare_for
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
-init_db()
+boot()
 
 def now_iso(): return datetime.utcnow().isoformat()+"Z"
 
@@ -20,10 +22,17 @@ def _before():
     g.t0 = time.time()
     g.trace_id = request.headers.get("X-Trace-Id", str(uuid.uuid4()))
     g.client = request.headers.get("X-Device-Id", request.remote_addr or "unknown")
+    g.prio = priority_for(request.method, request.path) if ADMISSION else None
+    g.admitted = False
+    if g.prio is not None:
+        g.admitted, wait = admission.acquire(g.prio)
+        if not g.admitted:
+            resp = jsonify({"error":"overloaded","class":PRIORITIES[g.prio]}); resp.status_code=503; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
 
 @app.after_request
 def _after(resp):
     ms = int((time.time()-g.t0)*1000)
+    g.status = resp.status_code
     metrics.observe(request.path, ms)
     resp.headers["X-Trace-Id"] = g.trace_id
     resp.headers["Server"] = "BikeShare-Flask"
@@ -31,6 +40,11 @@ def _after(resp):
              status=resp.status_code, ms=ms, idem=request.headers.get("Idempotency-Key"))
     return resp
 
+@app.teardown_request
+def _release(exc):
+    if g.get("admitted"):
+        admission.release(g.prio, int((time.time()-g.t0)*1000), exc is not None or g.get("status",500)>=500)
+
 @app.get("/")
 def index():
     metrics.inc("requests_/")
@@ -43,14 +57,14 @@ def index():
 def health(): metrics.inc("requests_/healthz"); return jsonify({"status":"ok","ts":now_iso()})
 
 @app.get("/metrics")
-def m(): metrics.inc("requests_/metrics"); return jsonify(metrics.snapshot())
+def m(): metrics.inc("requests_/metrics"); return jsonify({**metrics.snapshot(), "admission": admission.snapshot(), "startup": startup_stats()})
 
 # ---------- Devices ----------
 @app.post("/devices")
 def register():
     d = request.get_json(force=True) or {}
     if not {"id","name"} <= d.keys(): return jsonify({"error":"invalid"}), 400
-    with get_db() as conn:
+    with get_db(d["id"]) as conn:
         cur = conn.cursor()
         cur.execute("SELECT 1 FROM devices WHERE id=?", (d["id"],))
         if cur.fetchone():
@@ -62,7 +76,7 @@ def register():
 @app.put("/devices/<id>")
 def update_device(id):
     body = request.get_json(force=True) or {}
-    with get_db() as conn:
+    with get_db(id) as conn:
         cur = conn.cursor()
         cur.execute("UPDATE devices SET name=COALESCE(?,name), lock_state=COALESCE(?,lock_state), updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?",
                     (body.get("name"), body.get("lock_state"), id))
@@ -73,9 +87,8 @@ def update_device(id):
 def list_devices():
     near = request.args.get("near"); page=int(request.args.get("page",1)); limit=int(request.args.get("limit",20))
     offset=(page-1)*limit
-    with get_db() as conn:
-        cur = conn.cursor(); cur.execute("SELECT * FROM devices LIMIT ? OFFSET ?",(limit,offset))
-        items = [dict(r) for r in cur.fetchall()]
+    # each shard returns its first offset+limit by id; the merged page is the same as one big table's
+    items = sorted(fan_out("SELECT * FROM devices ORDER BY id LIMIT ?", (offset+limit,)), key=lambda d:d["id"])[offset:offset+limit]
     nearest=None
     if near:
         try:
@@ -87,7 +100,7 @@ def list_devices():
 
 @app.get("/devices/<id>")
 def device_detail(id):
-    with get_db() as conn:
+    with get_db(id) as conn:
         cur = conn.cursor(); cur.execute("SELECT * FROM devices WHERE id=?", (id,))
         r = cur.fetchone(); 
         return (jsonify({"error":"not found"}),404) if not r else jsonify(dict(r))
@@ -101,7 +114,7 @@ def telemetry(id):
     if not idem: return jsonify({"error":"missing Idempotency-Key"}), 400
     body = request.get_json(force=True) or {}
     payload_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
-    with get_db() as conn:
+    with get_db(id) as conn:
         cur = conn.cursor()
         cur.execute("SELECT ack_token FROM idempotency WHERE key=?", (idem,))
         row = cur.fetchone()
@@ -121,7 +134,7 @@ def unlock(id):
     allowed, wait = rate_limiter.allow("/devices/unlock", g.client)
     if not allowed:
         resp = jsonify({"error":"rate_limited"}); resp.status_code=429; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
-    with get_db() as conn:
+    with get_db(id) as conn:
         cur = conn.cursor(); cur.execute("UPDATE devices SET lock_state='unlocked', updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (id,))
         if cur.rowcount==0: return jsonify({"error":"not found"}), 404
         conn.commit()
@@ -132,7 +145,7 @@ def lock(id):
     allowed, wait = rate_limiter.allow("/devices/lock", g.client)
     if not allowed:
         resp = jsonify({"error":"rate_limited"}); resp.status_code=429; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
-    with get_db() as conn:
+    with get_db(id) as conn:
         cur = conn.cursor(); cur.execute("UPDATE devices SET lock_state='locked', updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (id,))
         if cur.rowcount==0: return jsonify({"error":"not found"}), 404
         conn.commit()
@@ -146,7 +159,8 @@ def start_ride():
         resp = jsonify({"error":"rate_limited"}); resp.status_code=429; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
     d = request.get_json(force=True) or {}
     if not {"id","user_id","device_id","start_lat","start_lon"} <= d.keys(): return jsonify({"error":"invalid"}), 400
-    with get_db() as conn:
+    if not claim_ride(d["id"], d["device_id"]): return jsonify({"error":"ride id in use"}), 409
+    with get_db(d["device_id"]) as conn:
         cur = conn.cursor(); cur.execute("SELECT * FROM rides WHERE id=?", (d["id"],))
         r = cur.fetchone()
         if r: return jsonify({"status":"existing","ride":dict(r)})
@@ -156,9 +170,28 @@ def start_ride():
         conn.commit()
     return jsonify({"status":"created","id":d["id"]}), 201
 
+# Ride sessions: one round trip each for unlock+ride+route and end+price+lock
+@app.post("/rides:start")
+def ride_session_start():
+    allowed, wait = rate_limiter.allow("/rides/start", g.client)
+    if not allowed:
+        resp = jsonify({"error":"rate_limited"}); resp.status_code=429; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
+    code, body = start_session(request.get_json(force=True) or {})
+    return jsonify(body), code
+
+@app.post("/rides/<id>:finish")
+def ride_session_finish(id):
+    allowed, wait = rate_limiter.allow("/rides/end", g.client)
+    if not allowed:
+        resp = jsonify({"error":"rate_limited"}); resp.status_code=429; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
+    code, body = finish_session(id, request.get_json(force=True) or {}, request.headers.get("X-Device-Id"))
+    return jsonify(body), code
+
 @app.get("/rides/<id>")
 def ride_detail(id):
-    with get_db() as conn:
+    shard = ride_shard(id, request.headers.get("X-Device-Id"))
+    if shard is None: return jsonify({"error":"not found"}),404
+    with get_db(shard=shard) as conn:
         cur = conn.cursor(); cur.execute("SELECT * FROM rides WHERE id=?", (id,))
         r = cur.fetchone(); return (jsonify({"error":"not found"}),404) if not r else jsonify(dict(r))
 
@@ -168,13 +201,15 @@ def end_ride(id):
     if not allowed:
         resp = jsonify({"error":"rate_limited"}); resp.status_code=429; resp.headers["Retry-After"]=f"{wait:.2f}"; return resp
     d = request.get_json(force=True) or {}
-    with get_db() as conn:
+    shard = ride_shard(id, request.headers.get("X-Device-Id"))
+    if shard is None: return jsonify({"error":"not found"}),404
+    with get_db(shard=shard) as conn:
         cur=conn.cursor(); cur.execute("SELECT * FROM rides WHERE id=?", (id,)); r=cur.fetchone()
         if not r: return jsonify({"error":"not found"}),404
         start={"lat":r["start_lat"],"lon":r["start_lon"]}; end={"lat":d.get("end_lat"),"lon":d.get("end_lon")}
         route = plan_route(start, end)
         cur.execute("UPDATE rides SET end_ts=strftime('%Y-%m-%dT%H:%M:%fZ','now'), end_lat=?, end_lon=?, fare=? WHERE id=?",
-                    (end["lat"], end["lon"], round(route["distance_m"]/1000*0.5,2), id))
+                    (end["lat"], end["lon"], fare_for(route), id))
         cur.execute("UPDATE devices SET lock_state='locked' WHERE id=?", (r["device_id"],))
         conn.commit()
     return jsonify({"status":"ended","route":route})
@@ -195,15 +230,18 @@ def weather_current():
 def policy(name):
     if name not in ("geofences","pricing"): return jsonify({"error":"not found"}), 404
     inm = request.headers.get("If-None-Match")
-    with get_db() as conn:
-        cur=conn.cursor(); cur.execute("SELECT blob,etag FROM policies WHERE name=?", (name,))
-        row=cur.fetchone()
-        if not row: return jsonify({"error":"missing"}),404
-        etag=row["etag"]
-        if inm and inm==etag:
-            resp = make_response("",304); resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
-        resp = make_response(row["blob"],200); resp.mimetype="application/json"
-        resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
+    cached = policy_cache(name)   # shared mmap artifact; DB only when artifacts are not attached
+    if cached: blob, etag = cached
+    else:
+        with get_db() as conn:
+            cur=conn.cursor(); cur.execute("SELECT blob,etag FROM policies WHERE name=?", (name,))
+            row=cur.fetchone()
+            if not row: return jsonify({"error":"missing"}),404
+            blob, etag = row["blob"], row["etag"]
+    if inm and inm==etag:
+        resp = make_response("",304); resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
+    resp = make_response(blob,200); resp.mimetype="application/json"
+    resp.headers["ETag"]=etag; resp.headers["Cache-Control"]="max-age=60"; return resp
 
 @app.get("/policies/geofences")
 def geos(): return policy("geofences")
@@ -220,7 +258,7 @@ def history(id):
     if start: q+=" AND ts >= ?"; P.append(start)
     if end:   q+=" AND ts <= ?"; P.append(end)
     q+=" ORDER BY ts DESC LIMIT ? OFFSET ?"; P.extend([limit, offset])
-    with get_db() as conn:
+    with get_db(id) as conn:
         cur=conn.cursor(); cur.execute(q, tuple(P)); rows=[dict(r) for r in cur.fetchall()]
     return jsonify({"items":rows,"next_page":(page+1 if len(rows)==limit else None)})
 
@@ -0,0 +1,28 @@
+# gunicorn -c backend_flask/gunicorn.conf.py backend_flask.app:app
+# gunicorn reads this file before it preloads the app, so migrations and mmap artifacts are prepared
+# here, once, in the master (hooks such as on_starting run too late: the preload import comes first).
+# The app and its mappings are then imported before fork, and workers share those pages copy-on-write.
+# Set BIKESHARE_PREPARE=0 when a separate deploy step runs `python -m common.startup prepare`.
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+bind = os.environ.get("BIND", ":5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+# Admission control (common.util.AdmissionController) sheds on each worker's in-flight count. A sync worker
+# never has more than one request in flight, so nothing would be shed and floods would queue instead. With
+# threads, in-flight can't pass `threads` and the rest waits in gunicorn's queue, where the controller can't
+# see it, so the limit starts at and is capped to `threads`: the lower classes then hit their share
+# (telemetry 70%) before the threads are used up, and the threads left over serve interactive calls.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+os.environ.setdefault("BIKESHARE_ADMISSION_LIMIT", str(threads))   # before the import below builds the controller
+os.environ.setdefault("BIKESHARE_ADMISSION_MAX", str(threads))
+preload_app = True
+
+from common import startup
+startup.ROLE = "master"
+if os.environ.get("BIKESHARE_PREPARE", "1") == "1": startup.prepare()
+
+def post_fork(server, worker):
+    startup.ROLE = "worker"
+    startup.report()
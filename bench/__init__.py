@@ -0,0 +1 @@
+# Micro-benchmarks for the common/ hot paths. Run: python -m bench [--compare] [--record]
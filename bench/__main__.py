@@ -0,0 +1,142 @@
+import argparse, hashlib, json, math, os, platform, subprocess, sys, time
+from .cases import CASES
+
+HERE = os.path.dirname(__file__)
+BASELINE = os.path.join(HERE, "baseline.json")
+HISTORY = os.path.join(HERE, "history.jsonl")
+
+def fingerprint():
+    try: commit = subprocess.run(["git","rev-parse","--short","HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip() or None
+    except OSError: commit = None
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "system": platform.system(), "platform": platform.platform(), "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(), "commit": commit}
+
+def measure(fn, min_time, repeat):
+    """ns per call over `repeat` timed runs; the loop count is calibrated so each run lasts >= min_time.
+    noise_pct is the interquartile spread of the runs relative to their median."""
+    n = 1
+    while True:
+        t0 = time.perf_counter_ns()
+        for _ in range(n): fn()
+        dt = time.perf_counter_ns() - t0
+        if dt >= min_time * 1e9: break
+        n *= 2 if dt == 0 else max(2, min(10, int(min_time * 1e9 / dt) + 1))
+    runs = [dt / n]
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter_ns()
+        for _ in range(n): fn()
+        runs.append((time.perf_counter_ns() - t0) / n)
+    runs.sort()
+    q = lambda p: runs[min(len(runs)-1, int(p*(len(runs)-1) + 0.5))]
+    med = q(0.5)
+    return {"median_ns": round(med, 1), "min_ns": round(runs[0], 1), "noise_pct": round((q(0.75) - q(0.25)) / med * 100, 1),
+            "loops": n, "repeat": repeat}
+
+def _calibration():
+    # fixed interpreter-bound work (dict/json/hash, like the cases); only used to scale results when comparing
+    # across environments, where raw medians are meaningless (see compare)
+    d = {f"k{i}": i*1.5 for i in range(32)}
+    return lambda: hashlib.sha256(json.dumps(d, sort_keys=True).encode()).digest()
+
+def run(pattern=None, min_time=0.2, repeat=9):
+    results, cal = {}, []
+    cal.append(measure(_calibration(), min_time, repeat))
+    for name, setup in CASES:
+        if pattern and pattern not in name: continue
+        results[name] = measure(setup(), min_time, repeat)
+        print(f"{name:45s} {results[name]['median_ns']:>12,.0f} ns/op  ±{results[name]['noise_pct']:.1f}%", file=sys.stderr)
+    cal.append(measure(_calibration(), min_time, repeat))   # before and after: drift during the run averages out
+    meds = [c["median_ns"] for c in cal]; mean = sum(meds) / len(meds)
+    return {"ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "env": fingerprint(), "calibration_ns": round(mean, 1),
+            # the scale factor is only as good as its own spread: within-run noise or before/after drift
+            "calibration_noise_pct": round(max([c["noise_pct"] for c in cal] + [(max(meds) - min(meds)) / mean * 100]), 1),
+            "results": results}
+
+# what makes raw timings comparable; not the full platform string, whose kernel build differs on every host
+ENV_KEYS = ("python", "implementation", "system", "machine", "cpu_count")
+
+def _env(env, k):
+    v = env.get(k)
+    return ".".join(v.split(".")[:2]) if k == "python" and v else v   # patch releases do not move these timings
+
+def env_mismatch(cur, base):
+    return [f"{k}: {_env(base['env'], k)} -> {_env(cur['env'], k)}" for k in ENV_KEYS if _env(base["env"], k) != _env(cur["env"], k)]
+
+def margin(r, b):
+    """3 standard errors of the % difference between two medians of `repeat` runs; sigma ~= IQR / 1.35 and
+    the median's standard error is ~1.25 sigma / sqrt(n). Per-run spread alone would let bursty cases pass anything."""
+    se = lambda x: 1.25 * x["noise_pct"] / 1.35 / math.sqrt(x.get("repeat", 1))
+    return 3 * math.hypot(se(r), se(b))
+
+def compare(cur, base, threshold, calibrated=False, confirm=False):
+    """Names of cases whose median slowed by more than max(threshold, margin) %. Raw medians are compared
+    (the environment matches); calibrated=True scales both sides by their calibration loop for a cross-machine
+    comparison and widens the margin by both calibrations' spread. confirm=True also requires the fastest run
+    to have slowed by > threshold: a real regression moves it, CPU-steal bursts on a shared box mostly do not."""
+    slower, new = [], []
+    for name, r in cur["results"].items():
+        b = base["results"].get(name)
+        if not b:
+            print(f"{name:45s} {'no baseline':>12s} -> {r['median_ns']:>12,.0f} ns/op (not gated)", file=sys.stderr)
+            new.append(name); continue
+        allowed = max(threshold, margin(r, b))
+        if calibrated:
+            pct = (r["median_ns"] / cur["calibration_ns"]) / (b["median_ns"] / base["calibration_ns"]) * 100 - 100
+            allowed += cur.get("calibration_noise_pct", 0) + base.get("calibration_noise_pct", 0)
+        else:
+            pct = r["median_ns"] / b["median_ns"] * 100 - 100
+        scale = cur["calibration_ns"] / base["calibration_ns"] if calibrated else 1
+        min_pct = r["min_ns"] / (b["min_ns"] * scale) * 100 - 100
+        bad = pct > allowed and (not confirm or min_pct > threshold)
+        print(f"{name:45s} {b['median_ns']:>12,.0f} -> {r['median_ns']:>12,.0f} ns/op ({pct:+6.1f}%, allowed {allowed:.0f}%"
+              + (f"; fastest run {min_pct:+.1f}%)" if confirm else ")") + ("  SLOWER" if bad else ""), file=sys.stderr)
+        if bad: slower.append(name)
+    if new: print(f"⚠️  {len(new)} case(s) not gated until the baseline is re-saved: " + ", ".join(new), file=sys.stderr)
+    return slower
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m bench", description="Micro-benchmarks for common/ hot paths")
+    ap.add_argument("-k", dest="pattern", help="only cases whose name contains this")
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    ap.add_argument("--repeat", type=int, default=9)
+    ap.add_argument("--out", help="write results JSON here (default: stdout)")
+    ap.add_argument("--compare", action="store_true", help=f"compare against {os.path.relpath(BASELINE)}; exit 1 on regression")
+    ap.add_argument("--threshold", type=float, default=15.0, help="allowed slowdown per case, %% (raised to 3 standard errors of the medians)")
+    ap.add_argument("--allow-env-mismatch", action="store_true", help="compare a baseline from a different machine/interpreter, scaled by the calibration loop")
+    ap.add_argument("--save-baseline", action="store_true", help="overwrite the committed baseline")
+    ap.add_argument("--record", action="store_true", help=f"append this run to {os.path.relpath(HISTORY)}")
+    args = ap.parse_args(argv)
+
+    cur = run(args.pattern, args.min_time, args.repeat)
+    if args.save_baseline:   # a noisy baseline loosens every later gate: retry noisy cases, keep the quietest run
+        for name, r in list(cur["results"].items()):
+            for _ in range(2):
+                if cur["results"][name]["noise_pct"] <= args.threshold / 3: break
+                again = measure(dict(CASES)[name](), args.min_time, args.repeat)
+                if again["noise_pct"] < cur["results"][name]["noise_pct"]: cur["results"][name] = again
+    out = json.dumps(cur, indent=2)
+    if args.out:
+        with open(args.out, "w") as f: f.write(out + "\n")
+    else: print(out)
+    if args.record:
+        with open(HISTORY, "a") as f: f.write(json.dumps(cur, separators=(",",":")) + "\n")
+    if args.save_baseline:
+        with open(BASELINE, "w") as f: f.write(out + "\n")
+    if args.compare:
+        with open(BASELINE) as f: base = json.load(f)
+        if "calibration_noise_pct" not in base: sys.exit("❌ baseline predates the current format; re-run with --save-baseline")
+        diff = env_mismatch(cur, base)
+        if diff:
+            print("❌ baseline was recorded on a different environment:\n   " + "\n   ".join(diff), file=sys.stderr)
+            if not args.allow_env_mismatch: sys.exit(2)
+        slower = compare(cur, base, args.threshold, calibrated=bool(diff))
+        if slower:   # confirm before failing: one slow repeat set on a shared box is not a regression
+            print(f"re-measuring {len(slower)} case(s)...", file=sys.stderr)
+            again = {**cur, "results": {n: measure(dict(CASES)[n](), args.min_time, args.repeat * 2) for n in slower}}
+            slower = compare(again, base, args.threshold, calibrated=bool(diff), confirm=True)
+        if slower:
+            print("❌ slower than baseline: " + ", ".join(slower), file=sys.stderr); sys.exit(1)
+        print("✅ within baseline", file=sys.stderr)
+
+if __name__ == "__main__": main()
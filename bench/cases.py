@@ -0,0 +1,97 @@
+import hashlib, json, io, contextlib, itertools, random, shutil, tempfile, sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.helpers import ack_token
+from common import db, startup, util
+from common.util import compute_etag, TokenBucket, RateLimiter, Metrics, AdmissionController, priority_for, plan_route, json_log
+
+# Each case is (name, setup) where setup() returns a zero-arg callable timed per call.
+# Scaling cases register one name per size so history/baselines compare like with like.
+CASES = []
+def case(name):
+    def deco(fn): CASES.append((name, fn)); return fn
+    return deco
+
+TELEMETRY = {"seq":42,"lat":-37.8136,"lon":144.9631,"battery":95.8,"lock_state":"locked"}
+POLICY = {"base":1.0,"per_min":0.2,"surge_zones":[{"center":[10,10],"radius":2,"multiplier":1.5}]}
+
+@case("helpers.ack_token")
+def _(): return lambda: ack_token(TELEMETRY)
+
+@case("telemetry.payload_hash")   # the re-dump both telemetry handlers do before the idempotency insert
+def _(): return lambda: hashlib.sha256(json.dumps(TELEMETRY, sort_keys=True).encode()).hexdigest()
+
+@case("util.compute_etag")
+def _(): return lambda: compute_etag(POLICY)
+
+@case("util.TokenBucket.consume")
+def _():
+    b = TokenBucket(1e9, 1e9)
+    return lambda: b.consume(1)
+
+for _n in (10, 1000, 100000):
+    @case(f"util.RateLimiter.allow[buckets={_n}]")
+    def _(n=_n):
+        rl = RateLimiter(); clients = [f"bike-{i}" for i in range(n)]
+        for c in clients: rl.allow("/devices/telemetry", c)
+        it = itertools.cycle(clients)
+        return lambda: rl.allow("/devices/telemetry", next(it))
+
+@case("util.AdmissionController.acquire+release")   # runs on every request in both middlewares
+def _():
+    a = AdmissionController()
+    def run():
+        p = priority_for("POST", "/devices/bike-001/telemetry")
+        ok, _ = a.acquire(p)
+        if ok: a.release(p, 5)
+    return run
+
+@case("util.Metrics.observe")
+def _():
+    m = Metrics()
+    return lambda: m.observe("/devices/{id}/telemetry", 12)
+
+for _n in (100, 1000, 10000):
+    @case(f"util.Metrics.snapshot[deque={_n}]")
+    def _(n=_n):
+        m = Metrics(); rng = random.Random(0)
+        for r in ("/healthz", "/devices/{id}/telemetry", "/rides"):
+            for _ in range(n): m.observe(r, rng.randint(1, 500))
+        return m.snapshot
+
+for _name, _dst in (("short", (-37.8100, 144.9580)), ("cross_city", (-37.7700, 145.0100))):
+    @case(f"util.plan_route[{_name}]")
+    def _(dst=_dst):
+        fr, to = {"lat":-37.8600,"lon":144.9150}, {"lat":dst[0],"lon":dst[1]}
+        return lambda: plan_route(fr, to)
+
+def _attached_views():
+    """(graph, coords, csr) as a worker sees them after startup.attach(): built from a scratch DB + artifact dir."""
+    tmp, saved = tempfile.mkdtemp(prefix="bench-startup-"), (db.DB_PATH, startup.ARTIFACT_DIR, util.graph, util.coords, util.csr)
+    db.DB_PATH, startup.ARTIFACT_DIR = os.path.join(tmp, "db.sqlite3"), os.path.join(tmp, "artifacts")
+    try:
+        db.migrate(); startup.build()
+        if not startup.attach(): raise RuntimeError("fresh artifacts did not attach")
+        return util.graph, util.coords, util.csr
+    finally:   # the mappings outlive the unlinked files
+        db.DB_PATH, startup.ARTIFACT_DIR, util.graph, util.coords, util.csr = saved
+        shutil.rmtree(tmp, ignore_errors=True)
+
+for _name, _dst in (("short", (-37.8100, 144.9580)), ("cross_city", (-37.7700, 145.0100))):
+    @case(f"util.plan_route[{_name},attached]")
+    def _(dst=_dst):
+        fr, to = {"lat":-37.8600,"lon":144.9150}, {"lat":dst[0],"lon":dst[1]}
+        views, own = _attached_views(), (util.graph, util.coords, util.csr)
+        def run():
+            util.graph, util.coords, util.csr = views
+            try: return plan_route(fr, to)
+            finally: util.graph, util.coords, util.csr = own
+        return run
+
+@case("util.json_log")
+def _():
+    sink = io.StringIO()
+    def run():
+        with contextlib.redirect_stdout(sink):
+            json_log(ts="2025-01-01T00:00:00Z", trace="t", m="POST", p="/devices/bike-001/telemetry", status=201, ms=3, idem="k")
+        sink.seek(0); sink.truncate()
+    return run
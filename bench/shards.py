@@ -0,0 +1,45 @@
+# Write throughput vs shard count: python -m bench.shards [--procs 8] [--writes 2000] [--shards 1 2 4 8]
+# Each process plays a slice of the fleet and commits one telemetry-style transaction per write
+# (idempotency insert + device update + telemetry insert), like the telemetry handlers do.
+import argparse, json, multiprocessing as mp, os, shutil, sys, tempfile, time
+
+def _writer(db_path, shards, devices, writes, start):
+    os.environ["BIKESHARE_DB"], os.environ["BIKESHARE_SHARDS"] = db_path, str(shards)
+    sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+    from common.db import transaction
+    start.wait()
+    for k in range(writes):
+        dev = devices[k % len(devices)]
+        with transaction(dev) as conn:
+            conn.execute("INSERT INTO idempotency(key,device_id,endpoint,seq) VALUES(?,?,?,?)", (f"{dev}:{k}", dev, "/devices/{id}/telemetry", k))
+            conn.execute("UPDATE devices SET lat=?,lon=?,battery=? WHERE id=?", (k*1e-6, k*1e-6, 100-k*1e-3, dev))
+            conn.execute("INSERT INTO telemetry(device_id,lat,lon,battery,lock_state) VALUES(?,?,?,?,?)", (dev, 0, 0, 100, "locked"))
+
+def run(shards, procs, writes, n_devices=1000):
+    d = tempfile.mkdtemp(prefix="bikeshare-shards-"); path = os.path.join(d, "db.sqlite3")
+    try:
+        os.environ["BIKESHARE_DB"], os.environ["BIKESHARE_SHARDS"] = path, str(shards)
+        import importlib, common.db as db
+        importlib.reload(db); db.migrate()
+        ids = [f"bike-{i:03d}" for i in range(n_devices)]
+        for i in ids:
+            with db.transaction(i) as conn: conn.execute("INSERT INTO devices(id,name) VALUES(?,?)", (i, i))
+        start = mp.Event()
+        ps = [mp.Process(target=_writer, args=(path, shards, ids[p::procs], writes, start)) for p in range(procs)]
+        for p in ps: p.start()
+        time.sleep(0.5); t0 = time.perf_counter(); start.set()
+        for p in ps: p.join()
+        dt = time.perf_counter() - t0
+        return {"shards": shards, "procs": procs, "writes": procs*writes, "seconds": round(dt, 3), "writes_per_s": round(procs*writes/dt, 1)}
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m bench.shards")
+    ap.add_argument("--procs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--writes", type=int, default=2000, help="transactions per process")
+    ap.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = ap.parse_args(argv)
+    for s in args.shards: print(json.dumps(run(s, args.procs, args.writes)), flush=True)
+
+if __name__ == "__main__": main()
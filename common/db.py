@@ -1,57 +1,111 @@
-import sqlite3, os, json, hashlib
+import sqlite3, os, re, glob, json, hashlib, zlib
 from contextlib import contextmanager
 
 DB_PATH = os.environ.get("BIKESHARE_DB", os.path.join(os.path.dirname(__file__), "..", "db.sqlite3"))
 
-def connect():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# ---- Device-sharded storage ----
+# Device-scoped rows (devices, telemetry, idempotency, rides, ride_sessions) live in the shard picked by
+# shard_for(device_id); each shard is its own SQLite file with its own WAL writer lock. Shard 0 is DB_PATH
+# and also holds the global tables (policies, ride_index). BIKESHARE_SHARDS=1 (default) is the single-file layout.
+# Changing the shard count does not move existing rows: startup refuses to run while misplaced() > 0,
+# and `python -m common.startup reshard` moves them.
+SHARDS = max(1, int(os.environ.get("BIKESHARE_SHARDS", "1")))
+
+def shard_path(i):
+    if i == 0: return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.s{i}{ext}"
+
+def shard_for(device_id):
+    # crc32, not hash(): str hashing is salted per process and every worker must agree
+    return zlib.crc32(str(device_id).encode()) % SHARDS if SHARDS > 1 else 0
+
+def connect(shard=0):
+    conn = sqlite3.connect(shard_path(shard), check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute("PRAGMA cache_size=-20000;")
     return conn
 
+def _shard(device_id, shard):
+    return shard if shard is not None else (shard_for(device_id) if device_id is not None else 0)
+
+@contextmanager
+def get_db(device_id=None, shard=None):
+    """Connection to the shard owning device_id (shard 0 when neither is given)."""
+    conn = connect(_shard(device_id, shard))
+    try:
+        yield conn
+    finally:
+        conn.close()
+
 @contextmanager
-def get_db():
-    conn = connect()
+def transaction(device_id=None, shard=None):
+    """One connection inside BEGIN IMMEDIATE: the write lock is taken up front, so read-then-write is atomic."""
+    conn = connect(_shard(device_id, shard))
     try:
+        conn.execute("BEGIN IMMEDIATE")
         yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback(); raise
     finally:
         conn.close()
 
-def init_db():
-    conn = connect()
-    cur = conn.cursor()
-    cur.executescript("""
-    CREATE TABLE IF NOT EXISTS devices(
+def fan_out(sql, params=()):
+    """Run a read on every shard; rows (as dicts) are concatenated in shard order."""
+    rows = []
+    for i in range(SHARDS):
+        with get_db(shard=i) as conn: rows += [dict(r) for r in conn.execute(sql, params)]
+    return rows
+
+def claim_ride(ride_id, device_id):
+    """Reserve ride_id fleet-wide for device_id in shard 0's ride_index; False when another device holds it.
+    Claims are never released: an id whose start then failed stays usable by the same device only."""
+    with transaction(shard=0) as conn:
+        conn.execute("INSERT OR IGNORE INTO ride_index(ride_id, device_id) VALUES(?,?)", (ride_id, device_id))
+        return conn.execute("SELECT device_id FROM ride_index WHERE ride_id=?", (ride_id,)).fetchone()[0] == device_id
+
+def ride_shard(ride_id, device_id=None):
+    """Shard for a ride: direct when the caller names its device (X-Device-Id), else via shard 0's ride_index;
+    None when the ride is unknown."""
+    if device_id: return shard_for(device_id)
+    if SHARDS == 1: return 0
+    with get_db(shard=0) as conn:
+        r = conn.execute("SELECT device_id FROM ride_index WHERE ride_id=?", (ride_id,)).fetchone()
+    return shard_for(r[0]) if r else None
+
+# ---- Versioned schema: PRAGMA user_version = number of MIGRATIONS applied ----
+# Each step gets the shard it runs on: device-scoped DDL runs on every shard, global tables only on shard 0.
+def _m1_base(cur, shard):
+    for stmt in ("""CREATE TABLE IF NOT EXISTS devices(
       id TEXT PRIMARY KEY, name TEXT NOT NULL,
       lock_state TEXT NOT NULL DEFAULT 'locked',
       lat REAL DEFAULT 0, lon REAL DEFAULT 0,
       battery REAL DEFAULT 100,
       updated_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
-    );
-    CREATE TABLE IF NOT EXISTS telemetry(
+    )""", """CREATE TABLE IF NOT EXISTS telemetry(
       id INTEGER PRIMARY KEY AUTOINCREMENT,
       device_id TEXT NOT NULL,
       ts TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
       lat REAL, lon REAL, battery REAL, lock_state TEXT,
       FOREIGN KEY(device_id) REFERENCES devices(id)
-    );
-    CREATE TABLE IF NOT EXISTS rides(
+    )""", """CREATE TABLE IF NOT EXISTS rides(
       id TEXT PRIMARY KEY, device_id TEXT NOT NULL, user_id TEXT NOT NULL,
       start_ts TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
       end_ts TEXT, start_lat REAL, start_lon REAL, end_lat REAL, end_lon REAL, fare REAL DEFAULT 0,
       FOREIGN KEY(device_id) REFERENCES devices(id)
-    );
-    CREATE TABLE IF NOT EXISTS idempotency(
+    )""", """CREATE TABLE IF NOT EXISTS idempotency(
       key TEXT PRIMARY KEY, device_id TEXT, endpoint TEXT, seq INTEGER,
       ts TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), payload_hash TEXT, ack_token TEXT
-    );
-    CREATE TABLE IF NOT EXISTS policies(
+    )"""):
+        cur.execute(stmt)
+    if shard: return
+    cur.execute("""CREATE TABLE IF NOT EXISTS policies(
       name TEXT PRIMARY KEY, blob TEXT NOT NULL, etag TEXT NOT NULL,
       updated_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
-    );
-    """)
+    )""")
     # seed default policies if empty
     cur.execute("SELECT COUNT(*) c FROM policies")
     if cur.fetchone()["c"] == 0:
@@ -64,4 +118,128 @@ def init_db():
             s = json.dumps(blob, sort_keys=True)
             etag = hashlib.sha256(s.encode()).hexdigest()
             cur.execute("INSERT INTO policies(name, blob, etag) VALUES(?,?,?)", (name, s, etag))
-    conn.commit(); conn.close()
+
+def _m2_ride_sessions(cur, shard):
+    cur.execute("""CREATE TABLE IF NOT EXISTS ride_sessions(
+      ride_id TEXT PRIMARY KEY, state TEXT NOT NULL, route TEXT, result TEXT, lock_token TEXT,
+      updated_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+      FOREIGN KEY(ride_id) REFERENCES rides(id)
+    )""")
+
+def _m3_global_tables_on_shard0(cur, shard):
+    # shards migrated before step 1 was split got their own, never-read copy of policies
+    if shard: cur.execute("DROP TABLE IF EXISTS policies")
+
+def _m4_ride_index(cur, shard):
+    # ride ids are unique per file only; the fleet-wide ride id -> device map lives on shard 0.
+    # Other shards' rides are copied in by _index_rides() before those shards reach this version.
+    if shard: return
+    cur.execute("CREATE TABLE IF NOT EXISTS ride_index(ride_id TEXT PRIMARY KEY, device_id TEXT NOT NULL)")
+    cur.execute("INSERT OR IGNORE INTO ride_index(ride_id, device_id) SELECT id, device_id FROM rides")
+
+# append only; never change what a released step does to existing data (IF NOT EXISTS keeps step 1 safe on
+# pre-versioning DBs)
+MIGRATIONS = [_m1_base, _m2_ride_sessions, _m3_global_tables_on_shard0, _m4_ride_index]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn=None):
+    """Version of one connection's DB, or the lowest across all shards when conn is None."""
+    if conn is not None: return conn.execute("PRAGMA user_version").fetchone()[0]
+    v = []
+    for i in range(SHARDS):
+        with get_db(shard=i) as c: v.append(schema_version(c))
+    return min(v)
+
+def _index_rides(shard):
+    """Copy one shard's rides into shard 0's ride_index (step 4). INSERT OR IGNORE: safe to repeat."""
+    conn = connect(0)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (shard_path(shard),))
+        if conn.execute("SELECT 1 FROM src.sqlite_master WHERE name='rides'").fetchone():
+            conn.execute("INSERT OR IGNORE INTO ride_index(ride_id, device_id) SELECT id, device_id FROM src.rides")
+            conn.commit()
+    finally:
+        conn.close()
+
+def _migrate(shard):
+    conn = connect(shard)
+    try:
+        v = schema_version(conn)
+        if v >= SCHEMA_VERSION: return v
+        # shard 0 is migrated first (migrate(), reshard()), so its ride_index exists; copying before this
+        # shard's version moves past 4 means a crash in between just repeats the copy
+        if shard and v < 4: _index_rides(shard)
+        conn.execute("BEGIN IMMEDIATE")
+        v0 = schema_version(conn); cur = conn.cursor()
+        for step in MIGRATIONS[v0:]: step(cur, shard)
+        cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+        return v0
+    finally:
+        conn.close()
+
+def migrate():
+    """Apply pending migrations once on every shard; returns (lowest from_version, to_version).
+    The version is re-read under the write lock, so racing workers apply each step exactly once."""
+    return min(_migrate(i) for i in range(SHARDS)), SCHEMA_VERSION
+
+def init_db(): return migrate()
+
+# ---- Moving rows after a shard-count change ----
+DEVICE_TABLES = ("devices", "telemetry", "idempotency", "rides", "ride_sessions")
+
+def shard_files():
+    """Indexes of every shard file on disk or configured, including ones left over from a larger SHARDS."""
+    root, ext = os.path.splitext(DB_PATH)
+    pat = re.compile(re.escape(root) + r"\.s(\d+)" + re.escape(ext) + "$")
+    extra = {int(m.group(1)) for m in map(pat.match, glob.glob(f"{glob.escape(root)}.s*{ext}")) if m}
+    return sorted(set(range(SHARDS)) | extra)
+
+def misplaced():
+    """Devices stored in a shard other than shard_for(id); must be 0 before serving (see reshard())."""
+    n = 0
+    for i in shard_files():
+        if SHARDS == 1 and i == 0: continue   # everything belongs to shard 0
+        with get_db(shard=i) as conn:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='devices'").fetchone(): continue
+            n += sum(shard_for(r[0]) != i for r in conn.execute("SELECT id FROM devices"))
+    return n
+
+def reshard():
+    """Move every device's rows to shard_for(device_id); returns {(from, to): devices moved}.
+    Run with the app stopped. Each move copies into the target and deletes from the source in one
+    BEGIN IMMEDIATE over both files; keyed tables are safe to re-run after a crash, but telemetry rows
+    copied before a crash between the two files' commits would be copied again."""
+    migrate()
+    for i in shard_files(): _migrate(i)   # left-over files may predate later steps
+    moved = {}
+    for i in shard_files():
+        conn = connect(i)
+        try:
+            conn.create_function("shard_for", 1, shard_for, deterministic=True)
+            targets = {shard_for(r[0]) for r in conn.execute("SELECT id FROM devices")} - {i}
+            for j in sorted(targets):
+                conn.execute("ATTACH DATABASE ? AS dst", (shard_path(j),))
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    cur = conn.cursor(); on = f"device_id IS NOT NULL AND shard_for(device_id)={j}"
+                    n = cur.execute(f"SELECT COUNT(*) FROM devices WHERE shard_for(id)={j}").fetchone()[0]
+                    cur.execute(f"INSERT OR IGNORE INTO dst.devices SELECT * FROM devices WHERE shard_for(id)={j}")
+                    cur.execute("INSERT INTO dst.telemetry(device_id,ts,lat,lon,battery,lock_state) "
+                                f"SELECT device_id,ts,lat,lon,battery,lock_state FROM telemetry WHERE {on} ORDER BY id")
+                    cur.execute(f"INSERT OR IGNORE INTO dst.idempotency SELECT * FROM idempotency WHERE {on}")
+                    cur.execute(f"INSERT OR IGNORE INTO dst.rides SELECT * FROM rides WHERE {on}")
+                    cur.execute("INSERT OR IGNORE INTO dst.ride_sessions SELECT s.* FROM ride_sessions s "
+                                f"JOIN rides r ON r.id=s.ride_id WHERE shard_for(r.device_id)={j}")
+                    cur.execute(f"DELETE FROM ride_sessions WHERE ride_id IN (SELECT id FROM rides WHERE {on})")
+                    for t in ("rides", "idempotency", "telemetry"): cur.execute(f"DELETE FROM {t} WHERE {on}")
+                    cur.execute(f"DELETE FROM devices WHERE shard_for(id)={j}")
+                    conn.commit()
+                except BaseException:
+                    conn.rollback(); raise
+                finally:
+                    conn.execute("DETACH DATABASE dst")
+                moved[(i, j)] = n
+        finally:
+            conn.close()
+    return moved
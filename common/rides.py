@@ -0,0 +1,71 @@
+import json, hmac, secrets
+from common.db import transaction, claim_ride
+from common.util import plan_route, nearest_node
+
+# ---- Ride sessions: started -> finished, each transition one transaction ----
+# Handlers return (status_code, body) so both backends share the state machine.
+# Both calls are idempotent by ride id: a retried start/finish replays the stored result.
+# start issues a random lock_token; finish must present it, so only the client that started a ride can end it.
+# Ride ids are claimed in shard 0's ride_index before the device's shard is touched, so an id is unique
+# across the fleet and not just within one shard file.
+
+def fare_for(route):
+    return round(route["distance_m"]/1000*0.5, 2)
+
+def _ride(cur, id):
+    cur.execute("SELECT * FROM rides WHERE id=?", (id,)); r = cur.fetchone()
+    return dict(r) if r else None
+
+def start_session(d):
+    if not {"id","user_id","device_id","start_lat","start_lon"} <= d.keys(): return 400, {"error":"invalid"}
+    start = {"lat":d["start_lat"],"lon":d["start_lon"]}
+    dest = {"lat":d["dest_lat"],"lon":d["dest_lon"]} if d.get("dest_lat") is not None and d.get("dest_lon") is not None else None
+    if not claim_ride(d["id"], d["device_id"]): return 409, {"error":"ride id in use"}
+    with transaction(d["device_id"]) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT state,route,lock_token FROM ride_sessions WHERE ride_id=?", (d["id"],)); s = cur.fetchone()
+        if s:
+            r = _ride(cur, d["id"])
+            if (r["device_id"], r["user_id"]) != (d["device_id"], d["user_id"]): return 409, {"error":"ride id in use"}
+            return 200, {"status":"existing","state":s["state"],"ride":r,
+                         "route":json.loads(s["route"]) if s["route"] else None,"lock_token":s["lock_token"]}
+        cur.execute("SELECT lock_state FROM devices WHERE id=?", (d["device_id"],)); dev = cur.fetchone()
+        if not dev: return 404, {"error":"device not found"}
+        if dev["lock_state"] == "unlocked": return 409, {"error":"device_busy"}
+        if _ride(cur, d["id"]): return 409, {"error":"ride exists outside a session"}
+        route = plan_route(start, dest) if dest else None
+        token = secrets.token_hex(16)
+        cur.execute("UPDATE devices SET lock_state='unlocked', updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (d["device_id"],))
+        cur.execute("INSERT INTO rides(id,device_id,user_id,start_lat,start_lon) VALUES(?,?,?,?,?)",
+                    (d["id"], d["device_id"], d["user_id"], d["start_lat"], d["start_lon"]))
+        cur.execute("INSERT INTO ride_sessions(ride_id,state,route,lock_token) VALUES(?,?,?,?)",
+                    (d["id"], "started", json.dumps(route, separators=(",",":")) if route else None, token))
+        return 201, {"status":"started","state":"started","ride":_ride(cur, d["id"]),"route":route,"lock_token":token}
+
+def finish_session(id, d, device_id=None):
+    """device_id (body, else the X-Device-Id header the backend passes) picks the shard: no fan-out per finish."""
+    device_id = d.get("device_id") or device_id
+    if d.get("end_lat") is None or d.get("end_lon") is None or not isinstance(d.get("lock_token"), str) or not d["lock_token"] or not device_id:
+        return 400, {"error":"invalid"}
+    end = {"lat":d["end_lat"],"lon":d["end_lon"]}
+    with transaction(device_id) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT s.state,s.route,s.result,s.lock_token FROM ride_sessions s JOIN rides r ON r.id=s.ride_id "
+                    "WHERE s.ride_id=? AND r.device_id=?", (id, device_id)); s = cur.fetchone()
+        if not s: return 404, {"error":"not found"}
+        # bytes: compare_digest rejects non-ASCII str with TypeError
+        if not hmac.compare_digest(d["lock_token"].encode(), s["lock_token"].encode()): return 403, {"error":"bad lock_token"}
+        if s["state"] == "finished": return 200, json.loads(s["result"])
+        r = _ride(cur, id)
+        # price off the route planned at start when the rider ended where they said they would
+        route = json.loads(s["route"]) if s["route"] else None
+        if not route or nearest_node(route["path"][-1]["lat"], route["path"][-1]["lon"]) != nearest_node(end["lat"], end["lon"]):
+            route = plan_route({"lat":r["start_lat"],"lon":r["start_lon"]}, end)
+        fare = fare_for(route)
+        cur.execute("UPDATE rides SET end_ts=strftime('%Y-%m-%dT%H:%M:%fZ','now'), end_lat=?, end_lon=?, fare=? WHERE id=?",
+                    (end["lat"], end["lon"], fare, id))
+        cur.execute("UPDATE devices SET lock_state='locked', updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE id=?", (r["device_id"],))
+        body = {"status":"finished","state":"finished","ride":_ride(cur, id),"fare":fare,"route":route}
+        cur.execute("UPDATE ride_sessions SET state='finished', result=?, updated_at=strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE ride_id=?",
+                    (json.dumps(body, separators=(",",":")), id))
+        return 200, body
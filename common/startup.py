@@ -0,0 +1,161 @@
+import os, sys, json, mmap, time, array, hashlib, resource
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common import db, util
+from common.util import json_log
+
+# ---- Worker startup: run migrations once, share read-only artifacts via mmap ----
+# prepare() migrates the DB and writes ARTIFACT_DIR/*.bin. It runs once per deploy, either as
+# `python -m common.startup prepare` or from backend_flask/gunicorn.conf.py before the app is preloaded.
+# Each worker's boot() only checks the schema version and maps the files, so the road graph and
+# policy cache live once in the page cache for every worker.
+ARTIFACT_DIR = os.environ.get("BIKESHARE_ARTIFACTS", os.path.join(os.path.dirname(db.DB_PATH), "artifacts"))
+AUTO_MIGRATE = os.environ.get("BIKESHARE_AUTO_MIGRATE", "0") == "1"   # local dev only: boot() runs prepare() itself
+MAGIC = b"BKSHART1"
+
+ROLE = "worker"   # gunicorn.conf.py sets "master": its preload import runs boot() before any worker exists
+info = {}         # boot report, served under /metrics -> startup
+_maps = {}        # name -> (mmap, {key: memoryview}); kept alive for the process lifetime
+
+def _fingerprint(conn):
+    etags = conn.execute("SELECT name, etag FROM policies ORDER BY name").fetchall()
+    s = f"v{db.SCHEMA_VERSION}|grid{util.GRID_N}|" + ",".join(f"{r['name']}={r['etag']}" for r in etags)
+    return hashlib.sha256(s.encode()).hexdigest()[:16]
+
+def _write(name, arrays):
+    """arrays: [(key, typecode, data)] -> ARTIFACT_DIR/<name>.bin; returns {key: (typecode, offset, length)}."""
+    path = os.path.join(ARTIFACT_DIR, name + ".bin"); tmp = f"{path}.{os.getpid()}.tmp"
+    layout, off = {}, len(MAGIC)
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for key, tc, data in arrays:
+            a = array.array(tc, data); pad = (-off) % 8
+            f.write(b"\0"*pad); off += pad
+            a.tofile(f); layout[key] = (tc, off, len(a)); off += len(a)*a.itemsize
+    os.replace(tmp, path)
+    return layout
+
+def build():
+    """Write graph/policy artifacts for the current schema + policies; returns the manifest."""
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    with db.get_db() as conn:
+        fp = _fingerprint(conn)
+        pols = {r["name"]: (r["blob"], r["etag"]) for r in conn.execute("SELECT name, blob, etag FROM policies")}
+    coords, graph = util.build_grid(); n = util.GRID_N
+    nodes = sorted(coords, key=lambda u: u[0]*n + u[1])
+    off, nbr, w = util.grid_csr(coords, graph)
+    manifest = {"fingerprint": fp, "built": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    manifest["graph"] = {"n": n, "arrays": _write("graph", [
+        ("lat", "d", (coords[u][0] for u in nodes)), ("lon", "d", (coords[u][1] for u in nodes)),
+        ("off", "i", off), ("nbr", "i", nbr), ("w", "i", w)])}
+    manifest["policies"] = {"etags": {k: v[1] for k, v in pols.items()},
+                            "arrays": _write("policies", [(k, "B", v[0].encode()) for k, v in sorted(pols.items())])}
+    tmp = os.path.join(ARTIFACT_DIR, f"manifest.json.{os.getpid()}.tmp")
+    with open(tmp, "w") as f: json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(ARTIFACT_DIR, "manifest.json"))
+    return manifest
+
+def _map(name, layout):
+    with open(os.path.join(ARTIFACT_DIR, name + ".bin"), "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(MAGIC)] != MAGIC: raise ValueError(f"bad artifact {name}")
+    mv = memoryview(mm)
+    _maps[name] = (mm, {k: mv[o:o + n*array.array(tc).itemsize].cast(tc) for k, (tc, o, n) in layout.items()})
+    return _maps[name][1]
+
+class GraphView:
+    """util.graph interface over the CSR arrays for callers outside the router (dijkstra reads util.csr
+    directly). Decodes on every lookup and caches nothing, so the mapping stays the only copy."""
+    def __init__(self, a, n): self.a, self.n = a, n
+    def __getitem__(self, u):
+        i = u[0]*self.n + u[1]; lo, hi = self.a["off"][i], self.a["off"][i+1]
+        return [(divmod(v, self.n), w) for v, w in zip(self.a["nbr"][lo:hi], self.a["w"][lo:hi])]
+    def get(self, u, default=None):
+        return self[u] if 0 <= u[0] < self.n and 0 <= u[1] < self.n else default
+
+class CoordView:
+    """util.coords interface: node -> (lat, lon)."""
+    def __init__(self, a, n): self.a, self.n = a, n
+    def __getitem__(self, u):
+        i = u[0]*self.n + u[1]; return (self.a["lat"][i], self.a["lon"][i])
+    def __len__(self): return self.n * self.n
+
+def attach():
+    """Map current artifacts into this process and point util at them; False if missing or stale."""
+    try:
+        with open(os.path.join(ARTIFACT_DIR, "manifest.json")) as f: m = json.load(f)
+    except (OSError, ValueError): return False
+    with db.get_db() as conn:
+        if m.get("fingerprint") != _fingerprint(conn): return False
+    g = _map("graph", m["graph"]["arrays"])
+    util.graph, util.coords = GraphView(g, util.GRID_N), CoordView(g, util.GRID_N)
+    util.csr = (g["off"], g["nbr"], g["w"])
+    _map("policies", m["policies"]["arrays"]); info["policy_etags"] = m["policies"]["etags"]
+    info["fingerprint"] = m["fingerprint"]
+    return True
+
+def policy_cache(name):
+    """(blob bytes, etag) from the shared policy artifact, or None when not attached."""
+    if "policies" not in _maps or name not in _maps["policies"][1]: return None
+    return bytes(_maps["policies"][1][name]), info["policy_etags"][name]
+
+def _check_shards():
+    n = db.misplaced()
+    if n: raise RuntimeError(f"{n} device(s) stored outside shard_for(id) with BIKESHARE_SHARDS={db.SHARDS}; "
+                             "run `python -m common.startup reshard` with the app stopped")
+
+def prepare():
+    """Out-of-band step (deploy job / gunicorn master): migrate, then rebuild artifacts if stale."""
+    v0, v1 = db.migrate()
+    _check_shards()
+    if not attach(): build(); attach()
+    json_log(event="prepare", schema_from=v0, schema_to=v1, artifacts=ARTIFACT_DIR, fingerprint=info.get("fingerprint"))
+
+def _proc_age_ms():
+    try:
+        with open("/proc/self/stat") as f: start = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f: up = float(f.read().split()[0])
+        return int((up - start/os.sysconf("SC_CLK_TCK"))*1000)
+    except (OSError, ValueError, IndexError): return None
+
+def memory():
+    """Current RSS and its file-backed/shared part in KB (falls back to peak RSS off Linux)."""
+    try:
+        with open("/proc/self/statm") as f: _, rss, shared = (int(x) for x in f.read().split()[:3])
+        pg = os.sysconf("SC_PAGE_SIZE") // 1024
+        return {"rss_kb": rss*pg, "shared_kb": shared*pg}
+    except (OSError, ValueError):
+        return {"rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "shared_kb": None}
+
+def report(role=None):
+    info.update(pid=os.getpid(), role=role or ROLE, cold_start_ms=_proc_age_ms(), **memory())
+    json_log(event="boot", **{k: info.get(k) for k in ("role","pid","schema_version","attached","boot_ms","cold_start_ms","rss_kb","shared_kb")})
+
+def boot():
+    """Per-worker startup, called at app import: check the schema version and map the artifacts.
+    Never migrates or builds (unless BIKESHARE_AUTO_MIGRATE=1); stale artifacts fall back to in-process data."""
+    t0 = time.perf_counter()
+    if AUTO_MIGRATE: prepare()
+    v = db.schema_version()
+    if v < db.SCHEMA_VERSION:
+        raise RuntimeError(f"schema v{v} < v{db.SCHEMA_VERSION}; run `python -m common.startup prepare` before starting workers")
+    _check_shards()
+    attached = attach()
+    if not attached: json_log(event="artifacts_stale", artifacts=ARTIFACT_DIR, hint="python -m common.startup prepare")
+    info.update(schema_version=v, attached=attached, boot_ms=round((time.perf_counter()-t0)*1000, 1))
+    report()
+
+def stats():
+    return {**{k: info.get(k) for k in ("role","pid","schema_version","attached","fingerprint","boot_ms","cold_start_ms")}, **memory()}
+
+if __name__ == "__main__":
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "prepare"
+    if cmd == "migrate": print("schema v%d -> v%d" % db.migrate())
+    elif cmd == "build": print(json.dumps(build(), indent=2))
+    elif cmd == "prepare": prepare()
+    elif cmd == "reshard":
+        for (i, j), n in db.reshard().items(): print(f"shard {i} -> {j}: {n} device(s)")
+        print(f"misplaced devices: {db.misplaced()}")
+    elif cmd == "status":
+        print(f"schema v{db.schema_version()} (latest v{db.SCHEMA_VERSION}) on {db.SHARDS} shard(s), "
+              f"{db.misplaced()} misplaced device(s); artifacts attached: {attach()}")
+    else: sys.exit("usage: python -m common.startup [migrate|build|prepare|reshard|status]")
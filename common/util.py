@@ -1,4 +1,4 @@
-import hashlib, json, time, math, threading, math
+import hashlib, json, time, math, threading, heapq, os, array
 from collections import defaultdict, deque
 
 def compute_etag(obj) -> str:
@@ -30,6 +30,61 @@ class RateLimiter:
 
 rate_limiter = RateLimiter()
 
+# ---- Adaptive admission control (AIMD on latency) with priority shedding ----
+# One controller per worker process. Class p may only use SHARE[p] of the current concurrency limit,
+# so as the limit shrinks under load history goes first, then telemetry, then policy reads; rider
+# operations keep the whole limit. Shed requests get 503 + Retry-After without touching the DB.
+PRIORITIES = ("interactive", "policy", "telemetry", "history")
+ADMISSION = os.environ.get("BIKESHARE_ADMISSION", "1") == "1"
+
+def priority_for(method, path):
+    """Priority class index for a request, or None when it is never shed (health, metrics, CORS preflight)."""
+    if method == "OPTIONS" or path in ("/", "/healthz", "/metrics"): return None
+    if path.startswith("/rides") or path.endswith("/unlock") or path.endswith("/lock"): return 0
+    if path.endswith("/telemetry"): return 2
+    if path.endswith("/history") or (method == "GET" and path == "/devices"): return 3
+    return 1
+
+class AdmissionController:
+    SHARE = (1.0, 0.9, 0.7, 0.5)
+    def __init__(self, initial=50, min_limit=5, max_limit=1000, tolerance=2.0, floor_ms=20.0, backoff=0.9, cooldown_s=0.1):
+        self.limit, self.min_limit, self.max_limit = float(initial), min_limit, max_limit
+        self.tolerance, self.floor_ms, self.backoff, self.cooldown_s = tolerance, floor_ms, backoff, cooldown_s
+        self.inflight, self.min_rtt, self.ewma, self.last_drop = 0, None, None, 0.0
+        self.admitted, self.shed = [0]*len(PRIORITIES), [0]*len(PRIORITIES)
+        self.lock = threading.Lock()
+    def target_ms(self):
+        return max(self.floor_ms, (self.min_rtt or 0) * self.tolerance)
+    def acquire(self, prio):
+        """(True, 0) and a slot taken, or (False, retry_after_s) when class prio is over its share."""
+        with self.lock:
+            if self.inflight < self.limit * self.SHARE[prio]:
+                self.inflight += 1; self.admitted[prio] += 1; return True, 0
+            self.shed[prio] += 1
+            return False, max(0.1, (self.ewma or self.floor_ms) / 1000 * (1 + prio))
+    def release(self, prio, ms, error=False):
+        with self.lock:
+            self.inflight -= 1
+            self.ewma = ms if self.ewma is None else self.ewma*0.9 + ms*0.1
+            # no-load latency estimate; drifts up slowly so one lucky sample cannot pin it forever
+            self.min_rtt = ms if self.min_rtt is None else min(ms, self.min_rtt + (ms - self.min_rtt)*0.001)
+            now = time.monotonic()
+            if error or self.ewma > self.target_ms():
+                if now - self.last_drop >= self.cooldown_s:   # at most one cut per cooldown, not per queued reply
+                    self.limit = max(self.min_limit, self.limit * self.backoff); self.last_drop = now
+            elif self.inflight + 1 >= self.limit * 0.5:       # only grow a limit that is actually in use
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+    def snapshot(self):
+        with self.lock:
+            return {"limit": round(self.limit, 1), "inflight": self.inflight,
+                    "min_rtt_ms": self.min_rtt, "ewma_ms": round(self.ewma, 1) if self.ewma is not None else None,
+                    "target_ms": self.target_ms(),
+                    "class_limits": {n: round(self.limit*s, 1) for n, s in zip(PRIORITIES, self.SHARE)},
+                    "admitted": dict(zip(PRIORITIES, self.admitted)), "shed": dict(zip(PRIORITIES, self.shed))}
+
+admission = AdmissionController(initial=int(os.environ.get("BIKESHARE_ADMISSION_LIMIT", "50")),
+                                max_limit=int(os.environ.get("BIKESHARE_ADMISSION_MAX", "1000")))
+
 # ---- In-memory metrics with percentile snapshots ----
 class Metrics:
     def __init__(self):
@@ -62,12 +117,62 @@ def weather_at(lat, lon, ts=None):
     return {"condition":"rain","wind":4.0,"rain_mm_h":5.0,"speed_factor":0.75}
 
 # ---- Grid route (Manhattan) & ETA ----
-# add near existing dijkstra() code
+# GRID_N x GRID_N street grid over central Melbourne; node = (row, col), edge weight = seconds to ride it
+GRID_N = int(os.environ.get("BIKESHARE_GRID_N", "20"))
+GRID_ORIGIN = (-37.8636, 144.9131); GRID_STEP = 0.1 / (GRID_N - 1)
+def build_grid():
+    coords, graph = {}, defaultdict(list)
+    for r in range(GRID_N):
+        for c in range(GRID_N):
+            coords[(r, c)] = (GRID_ORIGIN[0] + r*GRID_STEP, GRID_ORIGIN[1] + c*GRID_STEP)
+            for n in ((r+1, c), (r, c+1)):
+                if n[0] < GRID_N and n[1] < GRID_N:
+                    w = 60 + ((r*31 + c*17 + n[0]*7) % 5) * 15   # deterministic 60..120 s per block
+                    graph[(r, c)].append((n, w)); graph[n].append(((r, c), w))
+    return coords, graph
+
+def grid_csr(coords, graph):
+    """Compressed adjacency for dijkstra: node (r, c) <-> index r*GRID_N + c; neighbours of i are
+    nbr[off[i]:off[i+1]] with weights w[...]. Integer nodes and flat arrays, so the same code runs on
+    these in-process arrays and on the mmap'd artifact without building per-node objects."""
+    off, nbr, w = array.array("i", [0]), array.array("i"), array.array("i")
+    for u in sorted(coords, key=lambda u: u[0]*GRID_N + u[1]):
+        for v, wt in graph[u]: nbr.append(v[0]*GRID_N + v[1]); w.append(wt)
+        off.append(len(nbr))
+    return off, nbr, w
+
+# common.startup.attach() rebinds these to views over the shared mmap'd artifact
+coords, graph = build_grid()
+csr = grid_csr(coords, graph)
+
+def nearest_node(lat, lon):
+    snap = lambda x, o: min(GRID_N-1, max(0, int(round((x - o) / GRID_STEP))))
+    return (snap(lat, GRID_ORIGIN[0]), snap(lon, GRID_ORIGIN[1]))
+
+def dijkstra(s, g):
+    off, nbr, wt = csr; pop, push = heapq.heappop, heapq.heappush
+    s, g = s[0]*GRID_N + s[1], g[0]*GRID_N + g[1]
+    dist, prev, pq = [float("inf")] * (GRID_N*GRID_N), {}, [(0, s)]
+    dist[s] = 0
+    while pq:
+        d, u = pop(pq)
+        if u == g: break
+        if d > dist[u]: continue
+        for k in range(off[u], off[u+1]):
+            v, nd = nbr[k], d + wt[k]
+            if nd < dist[v]:
+                dist[v] = nd; prev[v] = u; push(pq, (nd, v))
+    path = [g]
+    while path[-1] != s: path.append(prev[path[-1]])
+    return dist[g], [divmod(i, GRID_N) for i in reversed(path)]
+
 def edge_weight(u, v):
-    for neigh, w in graph.get(u, []):
-        if neigh == v: return w
-    for neigh, w in graph.get(v, []):
-        if neigh == u: return w
+    if not all(0 <= x < GRID_N for x in (*u, *v)): return 0
+    off, nbr, wt = csr
+    for a, b in ((u, v), (v, u)):
+        i, j = a[0]*GRID_N + a[1], b[0]*GRID_N + b[1]
+        for k in range(off[i], off[i+1]):
+            if nbr[k] == j: return wt[k]
     return 0
 
 def plan_route(fr, to):
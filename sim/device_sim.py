@@ -1,57 +1,209 @@
-import asyncio, httpx, random, time, uuid, os, hashlib
+import asyncio, httpx, random, time, uuid, os, sys, hashlib, multiprocessing as mp
+from collections import defaultdict
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.util import plan_route, nearest_node, coords, GRID_N, json_log
 
 API = os.environ.get("API_BASE", "http://localhost:8000")
-def idem_key(device_id, seq): return hashlib.sha256(f"{device_id}:{seq}".encode()).hexdigest()
+TICK_S = float(os.environ.get("TICK_MS", "10")) / 1000      # timer-wheel resolution
+PERIOD_S = float(os.environ.get("PERIOD_S", "0.1"))         # telemetry period per device
+TIME_SCALE = float(os.environ.get("TIME_SCALE", "60"))      # simulated seconds per wall second
+RIDE_P = float(os.environ.get("RIDE_P", "0.005"))           # chance a parked bike is rented per step
+POOL = int(os.environ.get("POOL", "100"))                   # pooled connections per worker process
+INFLIGHT = int(os.environ.get("INFLIGHT", "1000"))          # max concurrent devices doing I/O per worker
+REPORT_S = float(os.environ.get("REPORT_S", "5"))
+
+# SEED fixes the model; RUN_ID (fresh per run unless set) namespaces what the server stores, so idempotency
+# keys and ride ids from an earlier run against the same DB are not replayed as duplicates
+def idem_key(run, device_id, seq): return hashlib.sha256(f"{run}:{device_id}:{seq}".encode()).hexdigest()
 
-async def post_with_retries(client, url, json=None, headers=None, N=6):
+stats = defaultdict(int)   # per-process sim-side counters, shipped to the parent every REPORT_S
+
+async def post_with_retries(client, url, json=None, headers=None, N=6, rng=random):
     base=0.2
     for a in range(N):
+        if a: stats["retries"]+=1
         try:
             r = await client.post(url, json=json, headers=headers, timeout=5.0)
-            if r.status_code in (200,201,304) or r.status_code==409: return r
-            if r.status_code==429:
-                await asyncio.sleep(float(r.headers.get("Retry-After","0.5"))+random.random()*0.1); continue
+            # success, or a 4xx that a retry cannot change (400 invalid, 404 unknown device, 409 ...): caller decides
+            if r.status_code < 400 or (r.status_code < 500 and r.status_code not in (408,429)): return r
+            if r.status_code in (429,503):
+                await asyncio.sleep(float(r.headers.get("Retry-After","0.5"))+rng.random()*0.1); continue
         except: pass
-        await asyncio.sleep(min(5.0, base*(2**a)) + random.random()*0.1)
+        await asyncio.sleep(min(5.0, base*(2**a)) + rng.random()*0.1)
     raise RuntimeError("max attempts")
 
-async def device_task(i, run_s=30):
-    device_id=f"bike-{i:03d}"
-    async with httpx.AsyncClient() as cl:
-        await cl.post(f"{API}/devices", json={"id":device_id,"name":f"Bike {i}"})
-        #lat,lon=random.randint(0,19),random.randint(0,19); 
-        # Center around Melbourne (-37.81, 144.96) with ±0.05° jitter
-        lat = -37.8136 + random.uniform(-0.05, 0.05)
-        lon = 144.9631 + random.uniform(-0.05, 0.05)
-        seq=0; t0=time.time()
-        while time.time()-t0 < run_s:
-            seq+=1
-            h={"Idempotency-Key": idem_key(device_id, seq), "X-Device-Id": device_id}
-            payload={"seq":seq,"lat":lat,"lon":lon,"battery":max(0,100-seq*0.1),"lock_state":"locked"}
-            await post_with_retries(cl, f"{API}/devices/{device_id}/telemetry", json=payload, headers=h)
-            lat += random.uniform(-0.001, 0.001)   # ~100 m
-            lon += random.uniform(-0.001, 0.001)
-            if random.random()<0.05:
-                ride=str(uuid.uuid4())
-                await cl.post(f"{API}/devices/{device_id}/unlock", json={"user_id":"u1","ride_id":ride}, headers={"X-Device-Id":device_id})
-                await cl.post(f"{API}/rides", json={"id":ride,"user_id":"u1","device_id":device_id,"start_lat":lat,"start_lon":lon}, headers={"X-Device-Id":device_id})
-                dest = {
-                    "lat": -37.8136 + random.uniform(-0.05, 0.05),
-                    "lon": 144.9631 + random.uniform(-0.05, 0.05)
-                }
-                rr=await cl.post(f"{API}/route/plan", json={"from":{"lat":lat,"lon":lon},"to":dest})
-                for p in rr.json().get("path",[])[:10]:
-                    seq+=1
-                    h={"Idempotency-Key": idem_key(device_id, seq), "X-Device-Id": device_id}
-                    payload={"seq":seq,"lat":p["lat"],"lon":p["lon"],"battery":max(0,100-seq*0.1),"lock_state":"unlocked"}
-                    await post_with_retries(cl, f"{API}/devices/{device_id}/telemetry", json=payload, headers=h)
-                    await asyncio.sleep(0.05)
-                await cl.patch(f"{API}/rides/{ride}/end", json={"end_lat":dest["lat"],"end_lon":dest["lon"]}, headers={"X-Device-Id":device_id})
-                await cl.post(f"{API}/devices/{device_id}/lock", json={}, headers={"X-Device-Id":device_id})
-            await asyncio.sleep(0.1)
-
-async def main():
+# ---- Hashed timer wheel: O(1) schedule, one bucket scan per tick ----
+class TimerWheel:
+    def __init__(self, tick_s, slots=1024):
+        self.tick_s, self.slots = tick_s, [[] for _ in range(slots)]
+        self.now = 0   # current tick
+    def schedule(self, item, delay_s):
+        ticks = max(1, int(round(delay_s / self.tick_s)))
+        due = self.now + ticks
+        self.slots[due % len(self.slots)].append((due, item))
+    def advance(self):
+        """Move to the next tick and return the items that fall due on it."""
+        self.now += 1
+        slot = self.slots[self.now % len(self.slots)]
+        due = [it for t, it in slot if t <= self.now]
+        if due: slot[:] = [(t, it) for t, it in slot if t > self.now]
+        return due
+
+# ---- Device model: parked bikes sit on a grid node, rented bikes ride along the road graph ----
+class Device:
+    def __init__(self, i, seed, run):
+        self.id, self.run = f"bike-{i:03d}", run
+        self.rng = random.Random(f"{seed}:{i}")   # str seeds hash identically in every process
+        # retry jitter draws depend on network failures, so they get their own stream; self.rng drives
+        # only the model (start node, ride decisions, destinations, ride ids) and stays reproducible
+        self.net_rng = random.Random(f"{seed}:{i}:net")
+        self.node = (self.rng.randrange(GRID_N), self.rng.randrange(GRID_N))
+        self.lat, self.lon = coords[self.node]
+        self.seq, self.battery = 0, 100.0
+        self.ride, self.legs = None, []    # legs: [(from, to, seconds)] still to ride
+        self.leg_t = 0.0
+        self.pending, self.busy = [], False
+        self.tokens = {}                   # ride id -> lock_token from /rides:start, presented on :finish
+
+    def step(self, dt):
+        """Advance dt simulated seconds; queue any ride transitions for the I/O task."""
+        if self.ride is None:
+            self.battery = max(0, self.battery - 0.001)
+            if self.rng.random() < RIDE_P:
+                dest = (self.rng.randrange(GRID_N), self.rng.randrange(GRID_N))
+                route = plan_route({"lat":self.lat,"lon":self.lon}, {"lat":coords[dest][0],"lon":coords[dest][1]})
+                pts = [nearest_node(p["lat"], p["lon"]) for p in route["path"]]
+                self.legs = list(zip(pts, pts[1:], route["segment_times_s"]))
+                self.ride = str(uuid.uuid5(uuid.NAMESPACE_OID, f"{self.run}:{self.rng.getrandbits(128)}"))
+                self.leg_t = 0.0
+                self.pending.append(("start", self.ride, (self.lat, self.lon), coords[dest]))
+            return
+        self.battery = max(0, self.battery - 0.05)
+        self.leg_t += dt
+        while self.legs and self.leg_t >= self.legs[0][2]:
+            self.leg_t -= self.legs[0][2]; self.node = self.legs.pop(0)[1]
+        if self.legs:
+            a, b, t = self.legs[0]; f = self.leg_t / t
+            self.lat = coords[a][0] + (coords[b][0]-coords[a][0])*f
+            self.lon = coords[a][1] + (coords[b][1]-coords[a][1])*f
+        else:
+            self.lat, self.lon = coords[self.node]
+            self.pending.append(("end", self.ride, (self.lat, self.lon)))
+            self.ride = None
+
+    def telemetry(self):
+        self.seq += 1
+        h = {"Idempotency-Key": idem_key(self.run, self.id, self.seq), "X-Device-Id": self.id}
+        return h, {"seq":self.seq,"lat":self.lat,"lon":self.lon,"battery":round(self.battery,3),
+                   "lock_state":"unlocked" if self.ride else "locked"}
+
+async def ride_event(cl, d, ev, h):
+    # ride sessions are idempotent by ride id, so both transitions are safe to retry
+    if ev[0] == "start":
+        _, ride, (lat, lon), dest = ev
+        r = await post_with_retries(cl, "/rides:start", json={"id":ride,"user_id":"u1","device_id":d.id,"start_lat":lat,"start_lon":lon,
+                                                              "dest_lat":dest[0],"dest_lon":dest[1]}, headers=h, rng=d.net_rng)
+        if r.status_code == 201: d.tokens[ride] = r.json()["lock_token"]; stats["ride_start"]+=1
+        else: stats["ride_refused"]+=1   # 409 busy/in use, or a 200 replay of a session this run did not open
+    else:
+        _, ride, (lat, lon) = ev
+        token = d.tokens.pop(ride, None)
+        if token is None: stats["ride_skipped"]+=1; return   # start was refused, nothing to finish
+        r = await post_with_retries(cl, f"/rides/{ride}:finish", json={"device_id":d.id,"end_lat":lat,"end_lon":lon,"lock_token":token}, headers=h, rng=d.net_rng)
+        stats["ride_end" if r.status_code == 200 else "ride_refused"]+=1
+
+async def device_io(cl, d, sem):
+    h = {"X-Device-Id": d.id}
+    try:
+        async with sem:
+            while d.pending: await ride_event(cl, d, d.pending.pop(0), h)
+            headers, payload = d.telemetry()
+            t0 = time.perf_counter()
+            r = await post_with_retries(cl, f"/devices/{d.id}/telemetry", json=payload, headers=headers, rng=d.net_rng)
+            if 200 <= r.status_code < 300:
+                stats["sent"]+=1; stats["latency_ms_sum"]+=int((time.perf_counter()-t0)*1000)
+            else: stats["duplicate" if r.status_code == 409 else "rejected"]+=1   # not acknowledged as new data
+    except Exception:
+        stats["errors"]+=1
+    finally:
+        d.busy = False
+
+async def close_out(cl, d, sem):
+    """At shutdown: send queued ride ends and finish rides still open, so no bike is left unlocked."""
+    h = {"X-Device-Id": d.id}
+    async with sem:
+        try:
+            for ev in d.pending:
+                if ev[0] == "end": await ride_event(cl, d, ev, h)
+            d.pending.clear()
+            if d.ride in d.tokens:
+                await ride_event(cl, d, ("end", d.ride, (d.lat, d.lon)), h); stats["ride_closed_at_exit"]+=1
+        except Exception:
+            stats["errors"]+=1
+
+async def run_shard(shard, ids, run_s, seed, run, q):
+    limits = httpx.Limits(max_connections=POOL, max_keepalive_connections=POOL)
+    async with httpx.AsyncClient(base_url=API, limits=limits, timeout=5.0) as cl:
+        devices = [Device(i, seed, run) for i in ids]
+        sem = asyncio.Semaphore(INFLIGHT)
+        async def register(d):
+            async with sem:
+                try:
+                    r = await post_with_retries(cl, "/devices", json={"id":d.id,"name":f"Bike {d.id[5:]}"}, rng=d.net_rng)
+                    if r.status_code not in (200,201): stats["register_failed"]+=1
+                except Exception: stats["register_failed"]+=1   # retries exhausted: its calls will 404
+        await asyncio.gather(*(register(d) for d in devices))
+
+        wheel = TimerWheel(TICK_S, slots=max(64, int(PERIOD_S/TICK_S)*2))
+        for d in devices: wheel.schedule(d, d.rng.uniform(0, PERIOD_S))   # stagger first sends
+        loop = asyncio.get_running_loop(); t0 = loop.time(); last = t0
+        def snap(): stats["sim_s"] = loop.time() - t0; return dict(stats)
+        tasks, end_tick = set(), int(run_s / TICK_S)
+        while wheel.now < end_tick:
+            for d in wheel.advance():
+                d.step(PERIOD_S * TIME_SCALE)
+                stats["target"]+=1
+                wheel.schedule(d, PERIOD_S)
+                if d.busy: stats["missed"]+=1; continue   # previous send still in flight
+                d.busy = True
+                t = asyncio.create_task(device_io(cl, d, sem)); tasks.add(t); t.add_done_callback(tasks.discard)
+            delay = t0 + wheel.now*TICK_S - loop.time()
+            await asyncio.sleep(max(0, delay))   # always yield so in-flight I/O progresses when behind
+            if loop.time() - last >= REPORT_S:
+                last = loop.time(); q.put((shard, snap(), len(tasks)))
+        final = snap()   # rates cover the run window, not the drain + close-out below
+        if tasks: await asyncio.wait(tasks, timeout=10.0)
+        await asyncio.gather(*(close_out(cl, d, sem) for d in devices if d.pending or d.ride))
+        q.put((shard, {**dict(stats), "sim_s": final["sim_s"]}, 0))
+
+def worker(shard, ids, run_s, seed, run, q):
+    asyncio.run(run_shard(shard, ids, run_s, seed, run, q))
+
+def main():
     N=int(os.environ.get("N_DEVICES","100")); RUN=int(os.environ.get("RUN_S","30"))
-    await asyncio.gather(*(asyncio.create_task(device_task(i,RUN)) for i in range(N)))
+    W=int(os.environ.get("WORKERS", str(min(os.cpu_count() or 1, max(1, N//1000)))))
+    SEED=int(os.environ.get("SEED","1")); RUN_ID=os.environ.get("RUN_ID") or uuid.uuid4().hex[:12]
+    q = mp.Queue()
+    procs = [mp.Process(target=worker, args=(w, range(w, N, W), RUN, SEED, RUN_ID, q), daemon=True) for w in range(W)]
+    for p in procs: p.start()
+    shards, target_rps, last = {}, N / PERIOD_S, 0.0
+    def report(final=False):
+        tot = defaultdict(int); inflight = 0; el = 1e-9
+        for s, fl in shards.values():
+            inflight += fl; el = max(el, s.get("sim_s", 0))
+            for k, v in s.items(): tot[k]+=v
+        json_log(sim="fleet", final=final, devices=N, workers=W, seed=SEED, run_id=RUN_ID, elapsed_s=round(el,1),
+                 target_rps=round(target_rps,1), achieved_rps=round(tot["sent"]/el,1),
+                 avg_ms=(tot["latency_ms_sum"]//tot["sent"] if tot["sent"] else None), inflight=inflight,
+                 **{k: tot[k] for k in ("sent","duplicate","rejected","missed","retries","errors","register_failed",
+                                         "ride_start","ride_end","ride_refused","ride_skipped","ride_closed_at_exit")})
+    while any(p.is_alive() for p in procs) or not q.empty():
+        try: shard, s, fl = q.get(timeout=REPORT_S)
+        except Exception: continue
+        shards[shard] = (s, fl)
+        if len(shards) == W and time.time() - last >= REPORT_S: last = time.time(); report()
+    for p in procs: p.join()
+    report(final=True)
 
-if __name__=="__main__": asyncio.run(main())
+if __name__=="__main__": main()
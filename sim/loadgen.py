@@ -2,7 +2,7 @@ import asyncio, httpx, time, csv, os, uuid
 
 API = os.environ.get("API_BASE", "http://localhost:8000")
 
-async def ping(client):
+async def ping(client, start):
     t0 = time.perf_counter()
     try:
         r = await client.get(f"{API}/healthz", timeout=5.0)
@@ -12,7 +12,8 @@ async def ping(client):
             "method": "GET",
             "path": "/healthz",
             "status": r.status_code,
-            "latency_ms": int(dt)
+            "latency_ms": int(dt),
+            "t_ms": int((t0 - start) * 1000)
         }
     except Exception:
         dt = (time.perf_counter() - t0) * 1000
@@ -21,16 +22,18 @@ async def ping(client):
             "method": "GET",
             "path": "/healthz",
             "status": "timeout",
-            "latency_ms": int(dt)
+            "latency_ms": int(dt),
+            "t_ms": int((t0 - start) * 1000)
         }
 
 async def run(conc=50, total=500):
     out = []
     sem = asyncio.Semaphore(conc)
+    start = time.perf_counter()
     async with httpx.AsyncClient() as c:
         async def one():
             async with sem:
-                out.append(await ping(c))
+                out.append(await ping(c, start))
         await asyncio.gather(*[asyncio.create_task(one()) for _ in range(total)])
     return out
 